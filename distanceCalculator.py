@@ -29,9 +29,14 @@ and performing asynchronous computation via threads. These
 examples may help you in designing your own objects, but you
 shouldn't need to modify the Distancer code in order to use its
 distances.
+
+Computed distances are also cached on disk, keyed by the layout's walls,
+so later processes map them from a file instead of recomputing them (see
+getCachedDistances).
 """
 
-import threading, sys, time, random
+import threading, sys, time, random, array, collections
+import hashlib, mmap, os, struct, tempfile
 
 class Distancer:
   def __init__(self, layout, background=True, default=10000):
@@ -76,11 +81,11 @@ class Distancer:
     return bestDistance
 
   def getDistanceOnGrid(self, pos1, pos2):
-    key = (pos1, pos2)
-    if key in self._distances:
-      return self._distances[key]
+    distances = self._distances
+    if pos1 in distances and pos2 in distances:
+      return distances.getDistance(pos1, pos2)
     else:
-      raise Exception("Positions not in grid: " + str(key))
+      raise Exception("Positions not in grid: " + str((pos1, pos2)))
 
   def isReadyForMazeDistance(self):
     return self._distances != None
@@ -132,7 +137,7 @@ class DistanceCalculator(threading.Thread):
       if distanceThread != None: raise Exception('Multiple distance threads')
       distanceThread = self
 
-      distances = computeDistances(self.layout)
+      distances = getCachedDistances(self.layout)
       print >>sys.stdout, '[Distancer]: Switching to maze distances'
 
       distanceMap[self.layout.walls] = distances
@@ -143,50 +148,234 @@ class DistanceCalculator(threading.Thread):
     distanceMapSemaphore.release()
     self.distancer._distances = distances
 
+class DistanceMatrix:
+  """
+  The maze distance between every pair of free cells of a layout. Free cells
+  are numbered in walls.asList(False) order, and the distances are kept in
+  one dense array('H') whose row i holds the distances from cell i, found by
+  a breadth-first search from it. Pairs with no path between them read as
+  sys.maxint.
+
+  The matrix can also be saved to a little-endian file and read back from
+  a memory map of it (see saveDistances and loadDistances), in which case
+  the distances stay in the file's pages rather than being copied.
+  """
+  UNREACHABLE = 0xFFFF
+
+  def __init__(self, layout, mappedFile=None):
+    self.cells, self.cellIds, neighbors = getFreeCellGraph(layout)
+    self.numCells = len(self.cells)
+
+    self.mappedFile = mappedFile
+    if mappedFile != None:
+      self.distances = None
+      return
+    self.distances = array.array('H')
+    for source in range(self.numCells):
+      self.distances.extend(breadthFirstDistances(source, neighbors))
+
+  def __contains__(self, pos):
+    return pos in self.cellIds
+
+  def getDistance(self, pos1, pos2):
+    "Both positions must be free cells of the layout."
+    index = self.cellIds[pos1] * self.numCells + self.cellIds[pos2]
+    if self.mappedFile != None:
+      distance = DISTANCE_ITEM.unpack_from(self.mappedFile, DISTANCE_HEADER.size + 2 * index)[0]
+    else:
+      distance = self.distances[index]
+    if distance == self.UNREACHABLE:
+      return sys.maxint
+    return distance
+
+class LazyDistances:
+  """
+  A stand-in for DistanceMatrix that computes nothing until asked for a
+  distance, then runs a breadth-first search from just the one cell needed.
+  At most maxRows of these rows are kept, the least recently used being
+  dropped first.
+  """
+  def __init__(self, layout, maxRows=1000):
+    self.layout = layout
+    self.maxRows = maxRows
+    self.cellIds = None
+    self.rows = collections.OrderedDict()
+
+  def _buildGraph(self):
+    self.cells, self.cellIds, self.neighbors = getFreeCellGraph(self.layout)
+
+  def __contains__(self, pos):
+    if self.cellIds == None: self._buildGraph()
+    return pos in self.cellIds
+
+  def getRow(self, cellId):
+    "The distances from one cell, computed if not already kept."
+    rows = self.rows
+    if cellId in rows:
+      row = rows.pop(cellId)
+    else:
+      row = array.array('H', breadthFirstDistances(cellId, self.neighbors))
+      if len(rows) >= self.maxRows:
+        rows.popitem(last=False)
+    rows[cellId] = row
+    return row
+
+  def getDistance(self, pos1, pos2):
+    "Both positions must be free cells of the layout."
+    if self.cellIds == None: self._buildGraph()
+    source, target = self.cellIds[pos1], self.cellIds[pos2]
+    # Distances are symmetric, so a kept row from either end will do
+    if target in self.rows and source not in self.rows:
+      source, target = target, source
+    distance = self.getRow(source)[target]
+    if distance == DistanceMatrix.UNREACHABLE:
+      return sys.maxint
+    return distance
+
+class LazyDistancer(Distancer):
+  """
+  A Distancer that starts instantly and finds maze distances on demand with
+  LazyDistances, instead of computing them all up front. Use it when only a
+  few distances will be asked for.
+  """
+  def __init__(self, layout, maxRows=1000, default=10000):
+    self._distances = LazyDistances(layout, maxRows)
+    self.default = default
+
+def getFreeCellGraph(layout):
+    """
+    Numbers the free cells of a layout in walls.asList(False) order. Returns
+    the cells, a dictionary from cell to number and the list of each cell's
+    free neighbors' numbers.
+    """
+    cells = layout.walls.asList(False)
+    if len(cells) >= DistanceMatrix.UNREACHABLE:
+      raise Exception('Layout has too many free cells for a distance matrix')
+    cellIds = dict([(cell, i) for i, cell in enumerate(cells)])
+    neighbors = []
+    for x, y in cells:
+      adjacent = [(x, y+1), (x, y-1), (x+1, y), (x-1, y)]
+      neighbors.append([cellIds[other] for other in adjacent if other in cellIds])
+    return cells, cellIds, neighbors
+
+def breadthFirstDistances(source, neighbors):
+  """
+  Returns the list of distances from cell source to every cell of the graph
+  given by neighbors, with DistanceMatrix.UNREACHABLE for cells with no path.
+  """
+  unreachable = DistanceMatrix.UNREACHABLE
+  row = [unreachable] * len(neighbors)
+  row[source] = 0
+  frontier = [source]
+  distance = 0
+  while frontier:
+    distance += 1
+    nextFrontier = []
+    append = nextFrontier.append
+    for cell in frontier:
+      for other in neighbors[cell]:
+        if row[other] == unreachable:
+          row[other] = distance
+          append(other)
+    frontier = nextFrontier
+  return row
+
 def computeDistances(layout):
-    distances = {}
-    allNodes = layout.walls.asList(False)
-    for source in allNodes:
-        dist = {}
-        closed = {}
-        for node in allNodes:
-            dist[node] = sys.maxint
-        import util
-        queue = util.PriorityQueue()
-        queue.push(source, 0)
-        dist[source] = 0
-        while not queue.isEmpty():
-            node = queue.pop()
-            if node in closed:
-                continue
-            closed[node] = True
-            nodeDist = dist[node]
-            adjacent = []
-            x, y = node
-            if not layout.isWall((x,y+1)):
-                adjacent.append((x,y+1))
-            if not layout.isWall((x,y-1)):
-                adjacent.append((x,y-1) )
-            if not layout.isWall((x+1,y)):
-                adjacent.append((x+1,y) )
-            if not layout.isWall((x-1,y)):
-                adjacent.append((x-1,y))
-            for other in adjacent:
-                if not other in dist:
-                    continue
-                oldDist = dist[other]
-                newDist = nodeDist+1
-                if newDist < oldDist:
-                    dist[other] = newDist
-                    queue.push(other, newDist)
-        for target in allNodes:
-            distances[(target, source)] = dist[target]
+    return DistanceMatrix(layout)
+
+######################################
+# ON-DISK CACHE OF DISTANCE MATRICES #
+######################################
+
+# Files are named by the SHA-1 of the wall grid and hold a header
+# (magic, width, height, number of free cells) then the matrix as
+# little-endian unsigned shorts.
+DISTANCE_MAGIC = 'PACDIST1'
+DISTANCE_HEADER = struct.Struct('<8sHHI')
+DISTANCE_ITEM = struct.Struct('<H')
+
+def getDistanceCacheDirectory():
+    """
+    The directory holding cached distance matrices: $PACMAN_DISTANCE_CACHE if
+    set (an empty value turns the cache off), else one in the temp directory.
+    """
+    directory = os.environ.get('PACMAN_DISTANCE_CACHE')
+    if directory == None:
+      directory = os.path.join(tempfile.gettempdir(), 'pacmanDistances')
+    return directory
+
+def getWallsHash(walls):
+    return hashlib.sha1(repr(walls.packBits())).hexdigest()
+
+def saveDistances(distances, filename, layout):
+    """
+    Writes a computed DistanceMatrix to filename. The file is written under a
+    temporary name and renamed into place, so readers never see half of it.
+    """
+    directory = os.path.dirname(filename) or '.'
+    handle, tempName = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+      f = os.fdopen(handle, 'wb')
+      try:
+        f.write(DISTANCE_HEADER.pack(DISTANCE_MAGIC, layout.width, layout.height, distances.numCells))
+        values = distances.distances
+        if sys.byteorder == 'big':
+          values = array.array('H', values)
+          values.byteswap()
+        values.tofile(f)
+      finally:
+        f.close()
+      os.rename(tempName, filename)
+    except:
+      if os.path.exists(tempName): os.remove(tempName)
+      raise
+
+def loadDistances(filename, layout):
+    """
+    Returns a DistanceMatrix reading from a memory map of filename, or None
+    if the file is missing or was not written for this layout's walls.
+    """
+    try:
+      f = open(filename, 'rb')
+    except IOError:
+      return None
+    try:
+      size = os.fstat(f.fileno()).st_size
+      if size < DISTANCE_HEADER.size: return None
+      mappedFile = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+      f.close()
+    magic, width, height, numCells = DISTANCE_HEADER.unpack_from(mappedFile, 0)
+    distances = DistanceMatrix(layout, mappedFile)
+    if magic != DISTANCE_MAGIC or (width, height) != (layout.width, layout.height) or \
+        numCells != distances.numCells or size != DISTANCE_HEADER.size + 2 * numCells * numCells:
+      mappedFile.close()
+      return None
+    return distances
+
+def getCachedDistances(layout):
+    """
+    Loads the layout's distances from the disk cache, computing and storing
+    them there first if needed. Without a usable cache directory the
+    distances are just computed.
+    """
+    directory = getDistanceCacheDirectory()
+    if not directory:
+      return computeDistances(layout)
+    filename = os.path.join(directory, getWallsHash(layout.walls) + '.dist')
+    distances = loadDistances(filename, layout)
+    if distances != None:
+      return distances
+    distances = computeDistances(layout)
+    try:
+      if not os.path.isdir(directory): os.makedirs(directory)
+      saveDistances(distances, filename, layout)
+    except (IOError, OSError):
+      pass
     return distances
 
 
 def getDistanceOnGrid(distances, pos1, pos2):
-    key = (pos1, pos2)
-    if key in distances:
-      return distances[key]
+    if pos1 in distances and pos2 in distances:
+      return distances.getDistance(pos1, pos2)
     return 100000
-
@@ -22,7 +22,7 @@
 # For more info, see http://inst.eecs.berkeley.edu/~cs188/sp09/pacman.html
 
 from util import *
-import time, os
+import time, os, string, itertools
 import traceback
 import sys
 
@@ -191,6 +191,7 @@ class Grid:
 
     def __eq__(self, other):
         if other == None: return False
+        if isinstance(other, BitGrid): return other == self
         return self.data == other.data
 
     def __hash__(self):
@@ -275,6 +276,96 @@ class Grid:
                 bools.append(False)
         return bools
 
+BIT_TO_DIGIT = string.maketrans('\x00\x01', '01')
+DIGIT_TO_BIT = string.maketrans('01', '\x00\x01')
+BIT_TO_LETTER = string.maketrans('\x00\x01', 'FT')
+BIT_INVERSE = string.maketrans('\x00\x01', '\x01\x00')
+
+class BitGrid(Grid):
+    """
+    A Grid of booleans whose columns are bytearrays holding 0 or 1 per cell.
+    grid[x][y] works as for Grid (reading back 0 or 1), but hashing, copying,
+    counting, comparing and bit packing run over whole columns at a time.
+    Its hash and packBits agree with a Grid holding the same cells.
+    """
+    def __init__(self, width, height, initialValue=False, bitRepresentation=None):
+        if initialValue not in [False, True]: raise Exception('Grids can only contain booleans')
+        self.CELLS_PER_INT = 30
+
+        self.width = width
+        self.height = height
+        self.data = [bytearray(chr(bool(initialValue)) * height) for x in range(width)]
+        if bitRepresentation:
+            self._unpackBits(bitRepresentation)
+
+    def __setitem__(self, key, item):
+        self.data[key] = bytearray(item)
+
+    def _bitString(self):
+        "Returns the cells in x * height + y order as a string of '0's and '1's."
+        return ''.join([str(column) for column in self.data]).translate(BIT_TO_DIGIT)
+
+    def __str__(self):
+        rows = zip(*[str(column).translate(BIT_TO_LETTER) for column in self.data])
+        rows.reverse()
+        return '\n'.join([''.join(row) for row in rows])
+
+    def __eq__(self, other):
+        if other == None: return False
+        if not isinstance(other, BitGrid):
+            return self.width == other.width and self.height == other.height and \
+                self.data == [bytearray(column) for column in other.data]
+        return self.data == other.data
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        # The same number Grid.__hash__ builds: bit x * height + y is cell (x, y)
+        bits = self._bitString()[::-1]
+        if not bits: return hash(0)
+        return hash(int(bits, 2))
+
+    def copy(self):
+        g = BitGrid(self.width, self.height)
+        g.data = [bytearray(column) for column in self.data]
+        return g
+
+    def shallowCopy(self):
+        g = BitGrid(self.width, self.height)
+        g.data = self.data
+        return g
+
+    def count(self, item =True ):
+        trues = sum([column.count('\x01') for column in self.data])
+        if item == True: return trues
+        if item == False: return self.width * self.height - trues
+        return 0
+
+    def asList(self, key = True):
+        ys = xrange(self.height)
+        list = []
+        for x, column in enumerate(self.data):
+            if not key: column = bytearray(str(column).translate(BIT_INVERSE))
+            list.extend([(x, y) for y in itertools.compress(ys, column)])
+        return list
+
+    def packBits(self):
+        bits = self._bitString()
+        size = self.CELLS_PER_INT
+        ints = [int(bits[i:i + size].ljust(size, '0'), 2) for i in range(0, len(bits), size)]
+        if len(bits) % size == 0:
+            ints.append(0)
+        return tuple([self.width, self.height] + ints)
+
+    def _unpackBits(self, bits):
+        size = self.CELLS_PER_INT
+        for packed in bits:
+            if packed < 0: raise ValueError, "must be a positive integer"
+        cells = ''.join([bin(packed)[2:].zfill(size) for packed in bits])
+        cells = cells[:self.width * self.height].ljust(self.width * self.height, '0').translate(DIGIT_TO_BIT)
+        self.data = [bytearray(cells[x * self.height:(x + 1) * self.height]) for x in range(self.width)]
+
 def reconstituteGrid(bitRep):
     if type(bitRep) is not type((1,2)):
         return bitRep
@@ -405,7 +496,8 @@ class GameStateData:
     def deepCopy( self ):
         state = GameStateData( self )
         state.food = self.food.deepCopy()
-        state.layout = self.layout.deepCopy()
+        # Layouts are never modified during a game, so copies share the original
+        state.layout = self.layout
         state._agentMoved = self._agentMoved
         state._foodEaten = self._foodEaten
         state._foodAdded = self._foodAdded
@@ -547,6 +639,17 @@ class Game:
         else:
             return self.rules.getProgress(self)
 
+    def getObservedState(self, agent, agentIndex):
+        """
+        Returns the state handed to an agent's observationFunction: a deep copy
+        of the game state, unless the rules can build a lighter observation
+        (getObservation, see slam.SlamRules) and the agent has not asked for
+        the full state by setting observeFullState.
+        """
+        if 'getObservation' in dir(self.rules) and not getattr(agent, 'observeFullState', False):
+            return self.rules.getObservation(self.state, agentIndex)
+        return self.state.deepCopy()
+
     def _agentCrash( self, agentIndex, quiet=False):
         "Helper method for handling agent crashes"
         if not quiet: traceback.print_exc()
@@ -633,7 +736,7 @@ class Game:
                         timed_func = TimeoutFunction(agent.observationFunction, int(self.rules.getMoveTimeout(agentIndex)))
                         try:
                             start_time = time.time()
-                            observation = timed_func(self.state.deepCopy())
+                            observation = timed_func(self.getObservedState(agent, agentIndex))
                         except TimeoutFunctionException:
                             skip_action = True
                         move_time += time.time() - start_time
@@ -643,7 +746,7 @@ class Game:
                         self.unmute()
                         return
                 else:
-                    observation = agent.observationFunction(self.state.deepCopy())
+                    observation = agent.observationFunction(self.getObservedState(agent, agentIndex))
                 self.unmute()
             else:
                 observation = self.state.deepCopy()
@@ -696,7 +799,10 @@ class Game:
             self.unmute()
 
             # Execute the action
+            intendedAction = action
             action = Actions.getNoisyAction(action, self.state.getLegalActions())
+            if 'recordMove' in dir(self.rules):
+                self.rules.recordMove(self.state, agentIndex, intendedAction, action)
             self.moveHistory.append( (agentIndex, action) )
             if self.catchExceptions:
                 try:
@@ -18,9 +18,67 @@ import util
 import random
 import game
 import slam
+import layout
 from game import Directions
 
-import copy, math, random
+import array, math, operator, random
+
+# Unit steps along each sonar ray, in the (N, E, S, W) order of the range tuple
+RAY_DIRECTIONS = [(0, 1), (1, 0), (0, -1), (-1, 0)]
+
+# Probability that the wall a particle's map predicts along a ray is not the one the
+# sonar saw. The sonar likelihood of every reading is mixed with this much of a
+# uniform one, so that one wrong cell of a map costs a particle weight, not its life.
+MAP_MISMATCH_PROB = 0.05
+
+# Inverse sensor model of the sonar: the log-odds each reading adds to the cells along
+# its ray, i.e. log P(reading | wall) - log P(reading | no wall). slam.addSonarNoise
+# reports max(0, min(d, d + e)) for a wall d steps away and noise e, so a reading m:
+# -is never longer than d. A cell the ray passed, fewer than m steps away, cannot be a
+#  wall then; a reading only passes a wall when the particle's pose or map is wrong
+#  (MAP_MISMATCH_PROB of the time), which gives LOG_ODDS_FREE.
+# -is exactly d when e >= 0 (SONAR_EXACT_PROB), and otherwise is j = -e steps short of
+#  a wall further on. The evidence for a wall m steps away therefore depends on the
+#  wall prior; see getSonarHitLogOdds(). A reading of 0 is always short and says
+#  nothing about any cell.
+SONAR_EXACT_PROB = sum([p for v, p in zip(slam.SONAR_NOISE_VALUES, slam.SONAR_NOISE_PROBS) if v >= 0])
+LOG_ODDS_FREE = math.log(MAP_MISMATCH_PROB)
+
+def getSonarHitLogOdds(wallPrior):
+    """
+    Returns the log-odds a reading of m >= 1 adds to the cell m steps away, whose
+    predecessors it found free: log P(m | wall at m) / P(m | no wall at m). Without a
+    wall at m, the first wall is j >= 1 steps further with probability
+    (1-wallPrior)^(j-1) * wallPrior (cells taken as independent) and is read as m when
+    the noise is -j.
+    """
+    short = 0.0
+    for v, p in zip(slam.SONAR_NOISE_VALUES, slam.SONAR_NOISE_PROBS):
+        if v < 0:
+            short += (1 - wallPrior) ** (-v - 1) * wallPrior * p
+    return math.log(SONAR_EXACT_PROB / short)
+
+def logOdds(p):
+    "Returns log(p/(1-p)), -inf for p=0."
+    if p == 0:
+        return float('-inf')
+    return math.log(p / (1.0 - p))
+
+def probability(l):
+    "Inverse of logOdds. Written with tanh so that no log-odds value can overflow."
+    return 0.5 + 0.5 * math.tanh(0.5 * l)
+
+def buildSonarLogLikelihoods(maxRange):
+    """
+    Returns the slam.ObservationTable of sonar readings up to maxRange (see
+    slam.getSonarReadingTable) for walls up to maxRange+1 steps away, mixed with
+    MAP_MISMATCH_PROB of a reading uniform over 0..maxRange.
+    """
+    return slam.getSonarReadingTable(maxRange, maxRange + 1).mixedWithUniform(MAP_MISMATCH_PROB)
+
+# Granularity of the motion noise draw: 36 of 40 outcomes follow the action (90%),
+# one each goes to the other three directions or stays put (2.5% each)
+MOTION_NOISE_STEPS = 40
 
 class InferenceModule:
     """
@@ -67,16 +125,508 @@ class InferenceModule:
         """
         pass
 
+class ParticleMapStore:
+    """
+    Keeps the wall maps of every particle in a single flat array of floats,
+    each cell holding the log-odds of that cell being a wall.
+    Map i occupies data[i*numCells:(i+1)*numCells], and within a map the
+    cell (x,y) lives at x*height + y (the same cell order Grid uses when it
+    packs its bits), so a column of the maze is a contiguous slice and a row
+    is a slice with step height.
+
+    Maps are copy-on-write: several particles may hold the same map index,
+    counted in refs. A map is only copied (into a freed map, or onto the end
+    of the array) when one of its holders asks to write to it.
+
+    Every map also has a weight, set by weigh() (0 for a freed map or a new
+    copy until then), and totals holds, for every cell, the sum of its wall
+    probability over all maps, each counted with its weight. probs mirrors
+    data with each cell's wall probability, also in float32, so a cell costs
+    8 bytes in all. Writes adjust totals as they happen, by the difference
+    between the new and old values of probs, so that totals only ever adds
+    and takes away the same float32 values and does not drift from them.
+    Weighing, sharing and releasing are cheap: counted records the weight
+    totals includes for each map, and the maps in pending, where that is
+    out of date, are brought up to date when totals is read. A copy made by
+    writable() into a freed map takes over the weight totals still counts
+    for the freed map, at the cost of one pass over the cells.
+    """
+    def __init__(self, numMaps, width, height, prior):
+        self.width = width
+        self.height = height
+        self.numCells = width * height
+        self.numMaps = numMaps
+        self.data = array.array('f', [logOdds(prior)]) * (numMaps * self.numCells)
+        self.probs = array.array('f', [probability(self.data[0])]) * (numMaps * self.numCells)
+        # A list rather than an array, which makes adding a whole map to it cheaper
+        self._totals = [self.probs[0] * numMaps] * self.numCells
+        self.refs = [1] * numMaps
+        self.weights = [1.0] * numMaps
+        self.counted = [1.0] * numMaps
+        self.pending = set()
+        self.free = []
+
+    def cellIndex(self, pos):
+        return pos[0] * self.height + pos[1]
+
+    def getMap(self, mapIndex):
+        "Returns a copy of the log-odds of map mapIndex as an array indexed by cellIndex."
+        start = mapIndex * self.numCells
+        return self.data[start:start + self.numCells]
+
+    def getCells(self, mapIndex, start, stop, step):
+        "Returns the log-odds of the cells start:stop:step of map mapIndex."
+        base = mapIndex * self.numCells
+        return self.data[base+start:base+stop:step]
+
+    def setCell(self, mapIndex, cell, value):
+        "Sets the log-odds of one cell of map mapIndex, which must be writable."
+        i = mapIndex * self.numCells + cell
+        self.data[i] = value
+        old = self.probs[i]
+        self.probs[i] = probability(self.data[i])
+        count = self.counted[mapIndex]
+        if count != 0:
+            self._totals[cell] += count * (self.probs[i] - old)
+
+    def addToCell(self, mapIndex, cell, delta):
+        "Adds delta to the log-odds of one cell of map mapIndex, which must be writable."
+        self.setCell(mapIndex, cell, self.data[mapIndex * self.numCells + cell] + delta)
+
+    def addToCells(self, mapIndex, start, stop, step, delta):
+        """
+        Adds delta to the log-odds of the cells start:stop:step of map
+        mapIndex, which must be writable, as one slice of data and probs.
+        """
+        base = mapIndex * self.numCells
+        cells = slice(base + start, base + stop, step)
+        values = array.array('f', [value + delta for value in self.data[cells]])
+        self.data[cells] = values
+        tanh = math.tanh
+        probs = array.array('f', [0.5 + 0.5*tanh(0.5*value) for value in values])
+        old = self.probs[cells]
+        self.probs[cells] = probs
+        count = self.counted[mapIndex]
+        if count != 0:
+            totals = self._totals
+            for cell, p, q in itertools.izip(xrange(start, stop, step), probs, old):
+                totals[cell] += count * (p - q)
+
+    def _addToTotals(self, values, count):
+        "Adds count times values, one per cell, to totals."
+        if count == 1:
+            self._totals = map(operator.add, self._totals, values)
+        elif count == -1:
+            self._totals = map(operator.sub, self._totals, values)
+        else:
+            self._totals = map(operator.add, self._totals,
+                               map(operator.mul, values, itertools.repeat(float(count), len(values))))
+
+    def _count(self, mapIndex):
+        "Brings the weight of mapIndex that totals includes up to date."
+        weight, count = self.weights[mapIndex], self.counted[mapIndex]
+        if weight != count:
+            C = self.numCells
+            self._addToTotals(self.probs[mapIndex*C:(mapIndex+1)*C], weight - count)
+            self.counted[mapIndex] = weight
+
+    def weigh(self, mapIndex, weight):
+        "Sets the weight totals counts mapIndex with, normally the total weight of its holders."
+        if self.weights[mapIndex] != weight:
+            self.weights[mapIndex] = weight
+            self.pending.add(mapIndex)
+
+    def share(self, mapIndex):
+        "Adds a holder to mapIndex and returns it."
+        self.refs[mapIndex] += 1
+        return mapIndex
+
+    def release(self, mapIndex):
+        "Removes a holder from mapIndex, freeing the map and dropping its weight when none are left."
+        self.refs[mapIndex] -= 1
+        if self.refs[mapIndex] == 0:
+            self.weigh(mapIndex, 0.0)
+            self.free.append(mapIndex)
+
+    def writable(self, mapIndex):
+        """
+        Returns a map index the caller may write to that holds the contents
+        of mapIndex: mapIndex itself if the caller is its only holder,
+        otherwise a private copy, of weight 0 until weighed.
+        """
+        if self.refs[mapIndex] == 1:
+            return mapIndex
+        self.refs[mapIndex] -= 1
+        C = self.numCells
+        source = self.data[mapIndex*C:(mapIndex+1)*C]
+        sourceProbs = self.probs[mapIndex*C:(mapIndex+1)*C]
+        if self.free:
+            copyIndex = self.free.pop()
+            count = self.counted[copyIndex]
+            if count != 0:
+                # The weight of the freed map that totals still includes counts the copy instead
+                self._addToTotals(map(operator.sub, sourceProbs, self.probs[copyIndex*C:(copyIndex+1)*C]), count)
+                self.pending.add(copyIndex)
+            self.data[copyIndex*C:(copyIndex+1)*C] = source
+            self.probs[copyIndex*C:(copyIndex+1)*C] = sourceProbs
+            self.refs[copyIndex] = 1
+        else:
+            copyIndex = self.numMaps
+            self.data.extend(source)
+            self.probs.extend(sourceProbs)
+            self.refs.append(1)
+            self.weights.append(0.0)
+            self.counted.append(0.0)
+            self.numMaps += 1
+        return copyIndex
+
+    def _getTotals(self):
+        "For every cell, the sum of its wall probability over all maps, each counted with its weight."
+        for mapIndex in self.pending:
+            self._count(mapIndex)
+        self.pending = set()
+        return self._totals
+
+    totals = property(_getTotals)
+
+# Changes of weight MapTileTree.totals ignores as the round-off of notes that cancel out
+WEIGHT_ROUNDOFF = 1e-9
+
+class MapTreeNode(object):
+    """
+    An inner node of a MapTileTree map: left covers the lower half of its
+    tiles and right the upper half. owner is the token of the one map that
+    may change the node in place; any other map copies it first.
+    """
+    __slots__ = ('owner', 'left', 'right')
+
+    def __init__(self, owner, left, right):
+        self.owner = owner
+        self.left = left
+        self.right = right
+
+    def copy(self, owner):
+        return MapTreeNode(owner, self.left, self.right)
+
+class MapTile(object):
+    """
+    A leaf of a MapTileTree map: the log-odds of the square block of cells
+    numbered index, by slot (see MapTileTree.cellSlot). Wall probabilities
+    are not kept as in ParticleMapStore, to keep tiles small.
+    """
+    __slots__ = ('owner', 'index', 'data')
+
+    def __init__(self, owner, index, data):
+        self.owner = owner
+        self.index = index
+        self.data = data
+
+    def copy(self, owner):
+        return MapTile(owner, self.index, array.array('f', self.data))
+
+class MapTileTree(object):
+    """
+    Holds particle maps with the interface of ParticleMapStore, but with
+    each map a persistent balanced binary tree over square tiles of
+    tileSide by tileSide cells instead of a flat slice. Square tiles keep
+    the number of tiles a sonar ray crosses low in every direction; smaller
+    ones copy less per write but cost more per cell in Python objects.
+
+    Maps share every subtree they have not changed. A map handle writes
+    through path copying: the tiles and nodes it does not own (see
+    MapTreeNode) are copied on the way down, so a write costs O(log tiles)
+    nodes and at most one tile copy, and nothing is copied when a map is
+    shared or made writable. Handles are reference counted as in
+    ParticleMapStore. Sharing, releasing or splitting a handle gives it a
+    fresh owner token, which freezes the tree it held until then.
+
+    Maps are weighed as in ParticleMapStore. Writes adjust totals cell by
+    cell as they happen, by the map's weight, but with the old probability
+    computed again from the old log-odds: tiles keep no mirror of
+    probabilities. A change of weight only notes the frozen tree it adds or
+    removes; when totals is next read, the noted trees are walked together,
+    node by node, and subtrees whose additions and removals cancel out (as
+    they mostly do between the particles of one resampling) are skipped.
+    The notes keep their trees alive, so they are also folded in as soon as
+    there are more of them than maps, which bounds the memory they hold for
+    callers that never read totals.
+    """
+    def __init__(self, numMaps, width, height, prior, tileSide=8):
+        self.width = width
+        self.height = height
+        self.numCells = width * height
+        self.tileSide = tileSide
+        self.tileSize = tileSide * tileSide
+        tilesHigh = (height + tileSide - 1) / tileSide
+        self.numTiles = (width + tileSide - 1) / tileSide * tilesHigh
+        # The tile and the slot within it of every cell, and the (slot, cell) pairs of every tile
+        self.cellTile = array.array('i', [0]) * self.numCells
+        self.cellSlot = array.array('i', [0]) * self.numCells
+        self.tileCells = [[] for i in range(self.numTiles)]
+        for x in range(width):
+            for y in range(height):
+                cell = x * height + y
+                tile = x / tileSide * tilesHigh + y / tileSide
+                slot = x % tileSide * tileSide + y % tileSide
+                self.cellTile[cell] = tile
+                self.cellSlot[cell] = slot
+                self.tileCells[tile].append((slot, cell))
+        self.numMaps = numMaps
+        self.prior = prior
+        root = self._build(object(), 0, self.numTiles)
+        self.roots = [root] * numMaps
+        self.owners = [object() for i in range(numMaps)]
+        # Tiles each handle owns, by tile number, valid while its owner token is
+        self.ownedTiles = [(None, None)] * numMaps
+        self.refs = [1] * numMaps
+        self.weights = [1.0] * numMaps
+        self.free = []
+        self._totals = array.array('d', [prior * numMaps]) * self.numCells
+        self.pending = []
+
+    def _build(self, owner, lo, hi):
+        if hi - lo == 1:
+            size = self.tileSize
+            return MapTile(owner, lo, array.array('f', [logOdds(self.prior)]) * size)
+        mid = (lo + hi) / 2
+        return MapTreeNode(owner, self._build(owner, lo, mid), self._build(owner, mid, hi))
+
+    def cellIndex(self, pos):
+        return pos[0] * self.height + pos[1]
+
+    def _leaves(self, node):
+        "The tiles under node, in order."
+        if isinstance(node, MapTile):
+            return [node]
+        return self._leaves(node.left) + self._leaves(node.right)
+
+    def getMap(self, mapIndex):
+        "Returns a copy of the log-odds of map mapIndex as an array indexed by cellIndex."
+        data = array.array('f', [0]) * self.numCells
+        for tile in self._leaves(self.roots[mapIndex]):
+            for slot, cell in self.tileCells[tile.index]:
+                data[cell] = tile.data[slot]
+        return data
+
+    def _tile(self, mapIndex, tileIndex):
+        "Returns tile tileIndex of map mapIndex, for reading only."
+        node = self.roots[mapIndex]
+        lo, hi = 0, self.numTiles
+        while not isinstance(node, MapTile):
+            mid = (lo + hi) / 2
+            if tileIndex < mid:
+                node, hi = node.left, mid
+            else:
+                node, lo = node.right, mid
+        return node
+
+    def getCells(self, mapIndex, start, stop, step):
+        "Returns the log-odds of the cells start:stop:step of map mapIndex."
+        cellTile, cellSlot = self.cellTile, self.cellSlot
+        values = []
+        tile = None
+        for cell in xrange(start, stop, step):
+            if tile == None or tile.index != cellTile[cell]:
+                tile = self._tile(mapIndex, cellTile[cell])
+            values.append(tile.data[cellSlot[cell]])
+        return values
+
+    def _writableTile(self, mapIndex, tileIndex):
+        "Returns tile tileIndex of map mapIndex, copying it and its path first if not owned."
+        owner = self.owners[mapIndex]
+        cacheOwner, tiles = self.ownedTiles[mapIndex]
+        if cacheOwner is owner:
+            if tileIndex in tiles:
+                return tiles[tileIndex]
+        else:
+            tiles = {}
+            self.ownedTiles[mapIndex] = (owner, tiles)
+        node = self.roots[mapIndex]
+        if node.owner is not owner:
+            node = node.copy(owner)
+            self.roots[mapIndex] = node
+        lo, hi = 0, self.numTiles
+        while not isinstance(node, MapTile):
+            mid = (lo + hi) / 2
+            if tileIndex < mid:
+                child = node.left
+                if child.owner is not owner:
+                    child = node.left = child.copy(owner)
+                hi = mid
+            else:
+                child = node.right
+                if child.owner is not owner:
+                    child = node.right = child.copy(owner)
+                lo = mid
+            node = child
+        tiles[tileIndex] = node
+        return node
+
+    def setCell(self, mapIndex, cell, value):
+        "Sets the log-odds of one cell of map mapIndex, which must be writable."
+        tile = self._writableTile(mapIndex, self.cellTile[cell])
+        i = self.cellSlot[cell]
+        self._totals[cell] += self.weights[mapIndex] * (probability(value) - probability(tile.data[i]))
+        tile.data[i] = value
+
+    def addToCell(self, mapIndex, cell, delta):
+        "Adds delta to the log-odds of one cell of map mapIndex, which must be writable."
+        tile = self._writableTile(mapIndex, self.cellTile[cell])
+        self.setCell(mapIndex, cell, tile.data[self.cellSlot[cell]] + delta)
+
+    def addToCells(self, mapIndex, start, stop, step, delta):
+        """
+        Adds delta to the log-odds of the cells start:stop:step of map
+        mapIndex, which must be writable.
+        """
+        cellTile, cellSlot = self.cellTile, self.cellSlot
+        totals = self._totals
+        weight = 0.5 * self.weights[mapIndex]
+        tanh = math.tanh
+        tile = None
+        for cell in xrange(start, stop, step):
+            tileIndex, i = cellTile[cell], cellSlot[cell]
+            if tile == None or tile.index != tileIndex:
+                tile = self._writableTile(mapIndex, tileIndex)
+                data = tile.data
+            old = data[i]
+            data[i] = old + delta
+            totals[cell] += weight*(tanh(0.5*data[i]) - tanh(0.5*old))
+
+    def weigh(self, mapIndex, weight):
+        "Sets the weight totals counts mapIndex with, normally the total weight of its holders."
+        change = weight - self.weights[mapIndex]
+        if change != 0:
+            self.weights[mapIndex] = weight
+            self.owners[mapIndex] = object()
+            self._note(self.roots[mapIndex], change)
+
+    def share(self, mapIndex):
+        "Adds a holder to mapIndex and returns it."
+        self.refs[mapIndex] += 1
+        self.owners[mapIndex] = object()
+        return mapIndex
+
+    def release(self, mapIndex):
+        "Removes a holder from mapIndex, freeing the map and dropping its weight when none are left."
+        self.refs[mapIndex] -= 1
+        self.owners[mapIndex] = object()
+        if self.refs[mapIndex] == 0:
+            self.weigh(mapIndex, 0.0)
+            self.roots[mapIndex] = None
+            self.free.append(mapIndex)
+
+    def _note(self, root, count):
+        "Notes count more weight of the frozen tree root for totals."
+        self.pending.append((root, count))
+        if len(self.pending) > self.numMaps:
+            self._applyPending()
+
+    def writable(self, mapIndex):
+        """
+        Returns a map index the caller may write to that holds the contents
+        of mapIndex: mapIndex itself if the caller is its only holder,
+        otherwise a new handle on the same tree, of weight 0 until weighed.
+        """
+        if self.refs[mapIndex] == 1:
+            return mapIndex
+        self.refs[mapIndex] -= 1
+        self.owners[mapIndex] = object()
+        if self.free:
+            copyIndex = self.free.pop()
+            self.roots[copyIndex] = self.roots[mapIndex]
+            self.owners[copyIndex] = object()
+            self.refs[copyIndex] = 1
+            self.weights[copyIndex] = 0.0
+        else:
+            copyIndex = self.numMaps
+            self.roots.append(self.roots[mapIndex])
+            self.owners.append(object())
+            self.ownedTiles.append((None, None))
+            self.refs.append(1)
+            self.weights.append(0.0)
+            self.numMaps += 1
+        return copyIndex
+
+    def _applyPending(self):
+        "Adds each tree noted by weigh() to totals with the change of weight noted for it."
+        counts = {}
+        for root, count in self.pending:
+            entry = counts.setdefault(id(root), [root, 0])
+            entry[1] += count
+        self.pending = []
+        totals = self._totals
+        while counts:
+            children = {}
+            for node, count in counts.itervalues():
+                # Weights are floats, so notes that cancel out may leave round-off
+                if abs(count) < WEIGHT_ROUNDOFF:
+                    continue
+                if isinstance(node, MapTile):
+                    data = node.data
+                    for slot, cell in self.tileCells[node.index]:
+                        totals[cell] += count * probability(data[slot])
+                    continue
+                for child in (node.left, node.right):
+                    entry = children.setdefault(id(child), [child, 0])
+                    entry[1] += count
+            counts = children
+
+    def _getTotals(self):
+        """
+        For every cell, the sum of its wall probability over all maps, each
+        counted with its weight, as in ParticleMapStore.totals.
+        """
+        if self.pending:
+            self._applyPending()
+        return self._totals
+
+    totals = property(_getTotals)
+
+class PathNode(object):
+    """
+    One pose in the ancestry tree of particle trajectories. Every particle
+    points at the node of its current position and each node points at the
+    one before it, so particles duplicated by resampling share their common
+    history. A branch whose particles have all died is no longer referenced
+    and is freed by Python, which keeps the tree at O(particles) new nodes
+    per step.
+    """
+    __slots__ = ('pos', 'parent')
+
+    def __init__(self, pos, parent):
+        self.pos = pos
+        self.parent = parent
+
 class Particle():
-    def __init__(self, startPos, h, w, prior):
-        self.path = [startPos]
-        self.walls = util.Counter()
-        self.importance = 0
-        for i in range(w):
-            for j in range(h):
-                self.walls[(i,j)]=prior
-        self.walls[startPos]=0
-    
+    def __init__(self, node, mapIndex):
+        self.node = node
+        self.mapIndex = mapIndex
+        self.importance = 1
+
+    def getPosition(self):
+        return self.node.pos
+
+    def move(self, pos):
+        "Appends pos to this particle's trajectory."
+        self.node = PathNode(pos, self.node)
+
+    def getPath(self):
+        "Returns the whole trajectory of this particle, oldest position first."
+        path = []
+        node = self.node
+        while node != None:
+            path.append(node.pos)
+            node = node.parent
+        path.reverse()
+        return path
+
+    def copy(self, maps):
+        "Returns a duplicate of this particle that shares its map in maps and its trajectory."
+        particle = Particle(self.node, maps.share(self.mapIndex))
+        particle.importance = self.importance
+        return particle
+
 class SLAMParticleFilter(InferenceModule):
     """
     Particle filtering inference module for use in SLAM.
@@ -84,89 +634,75 @@ class SLAMParticleFilter(InferenceModule):
     
     "*** YOU MAY ADD WHATEVER HELPER METHODS YOU WANT TO THIS CLASS ***"    
 
-   
+    # Where the particles' maps are kept; see FastSLAMParticleFilter
+    mapStoreClass = ParticleMapStore
     
-    def __init__(self, startPos, layoutWidth, layoutHeight, wallPrior, legalPositions, numParticles=100):
+    def __init__(self, startPos, layoutWidth, layoutHeight, wallPrior, legalPositions, numParticles=100, resampleThreshold=0.5, sonarWeighting=True):
         # "*** YOU OVERWRITE THIS METHOD HOWEVER YOU WANT ***"
         """
         -For __init__, we build a self.particles list which contains all 
          the particles, each particle is represented as a Particle Class object. 
         -The initial state of the self.particles: all particles are put in self.startPos
+        -resampleThreshold: we only resample once the effective sample size drops below
+         resampleThreshold*numParticles (1.0 resamples whenever any particle lost weight).
+        -sonarWeighting: weight particles by how well their own maps explain each sonar reading (see
+         weightParticles()); without it only out-of-bounds readings change importances.
         """
         self.numParticles=numParticles
+        self.resampleThreshold=resampleThreshold
         self.legalPositions = legalPositions
         self.particles = []
         self.wallPrior=wallPrior
+        self.logOddsHit = getSonarHitLogOdds(wallPrior)
         self.layoutHeight = layoutHeight
         self.layoutWidth = layoutWidth
+        self.maps = self.mapStoreClass(numParticles, layoutWidth, layoutHeight, wallPrior)
+        startCell = self.maps.cellIndex(startPos)
+        start = PathNode(startPos, None)
         for i in range(numParticles):
-            self.particles.append(Particle(startPos, layoutHeight, layoutWidth, wallPrior))
-
-
-    def rand(self, i, new):
-        """
-        -parameters: i indicates the direction pacman received, new is the current position of a particle
-        -This is a helper function used in updateEach() function. Because the probabiltiy of pacman moving
-         into its prevAction direction 90%, we generate random number according to the probability to 
-         determine where each particle is moving toward. 
-        -return value is the new position the particle is at.
-        """
-        r = random.randint(1,1000)
-        if i==0:
-            if r<=900:
-                new[1]+=1
-            elif r<=925:
-                new[1]-=1
-            elif r<=950:
-                new[0]+=1
-            elif r<=975:
-                new[0]-=1
-        elif i==1:
-            if r<=900:
-                new[0]+=1
-            elif r<=925:
-                new[0]-=1
-            elif r<=950:
-                new[1]+=1
-            elif r<=975:
-                new[1]-=1
-        elif i==2:
-            if r<=900:
-                new[1]-=1
-            elif r<=925:
-                new[1]+=1
-            elif r<=950:
-                new[0]+=1
-            elif r<=975:
-                new[0]-=1
-        elif i==3:
-            if r<=900:
-                new[0]-=1
-            elif r<=925:
-                new[0]+=1
-            elif r<=950:
-                new[1]+=1
-            elif r<=975:
-                new[1]-=1
-        else:
-            if r<=900:
-                pass
-            elif r<=925:
-                new[1]-=1
-            elif r<=950:
-                new[0]+=1
-            elif r<=975:
-                new[0]-=1
-            else:
-                new[1]+=1
+            self.particles.append(Particle(start, i))
+            self.maps.setCell(i, startCell, logOdds(0))
+        self.buildMotionTable()
+        self.sonarWeighting = sonarWeighting
+        self.sonarLogLikelihoods = buildSonarLogLikelihoods(max(layoutWidth, layoutHeight))
 
-        return new
+
+    def buildMotionTable(self):
+        """
+        -This is a helper function used in __init__. Pacman moves in its prevAction direction 90% of the time
+         and goes to each of the other three directions or stays put 2.5% of the time each.
+        -We precompute, for every direction i received (index into RAY_DIRECTIONS, 4 for no move), a table
+         of MOTION_NOISE_STEPS successor dicts: the first 90% of them map every position to its neighbour in
+         direction i, the remaining ones to the other outcomes. A particle then moves with one uniform draw
+         and one dict lookup.
+        -Moves that would leave the layout or enter its border, which Pacman knows is all wall, leave the
+         particle where it is.
+        """
+        vectors = RAY_DIRECTIONS + [(0, 0)]
+        successors = []
+        for dx, dy in vectors:
+            successor = {}
+            for x in range(self.layoutWidth):
+                for y in range(self.layoutHeight):
+                    nx, ny = x + dx, y + dy
+                    if 0 < nx < self.layoutWidth - 1 and 0 < ny < self.layoutHeight - 1:
+                        successor[(x, y)] = (nx, ny)
+                    else:
+                        successor[(x, y)] = (x, y)
+            successors.append(successor)
+        intended = int(MOTION_NOISE_STEPS*0.9)
+        self.motionTable = []
+        for i in range(len(vectors)):
+            others = [successors[j] for j in range(len(vectors)) if j != i]
+            self.motionTable.append([successors[i]]*intended + others)
 
 
     def observe(self, prevAction, ranges):
         """
         -this function is called at every time stamp. we first call updateEach() function to update each 
          particles and then we call resampleParticles() to resample the particles. i.e. particle filtering.
+        -Resampling is skipped while the effective sample size stays at or above
+         resampleThreshold*numParticles.
         """
         if prevAction==Directions.NORTH:
             i=0
@@ -179,163 +715,241 @@ class SLAMParticleFilter(InferenceModule):
         else:
             i=4
         self.updateEach(ranges, i)
-        self.resampleParticles()
+        if self.effectiveSampleSize() < self.resampleThreshold*len(self.particles):
+            self.resampleParticles()
+
+
+    def weighMaps(self):
+        """
+        -gives every map in self.maps the total importance of the particles holding it as its weight, so that
+         the sum kept for getWallBeliefDistribution() counts each particle by its importance. Between
+         resamplings importances differ, and the maps of particles with importance 0 drop out of the sum.
+        -self.maps keeps its sum right whatever the weights are, so this is only needed before the sum is read.
+        """
+        weights = {}
+        for p in self.particles:
+            weights[p.mapIndex] = weights.get(p.mapIndex, 0.0) + p.importance
+        for mapIndex, weight in weights.iteritems():
+            self.maps.weigh(mapIndex, weight)
 
 
     def updateEach(self, ranges, i):
         """
         -parameters: ranges is the range measurement, i indicates the direction pacman is supposed to go according
          to prevAction
-        -in this funciton, we loop over all the particles in self.particles list, we call self.rand() to genterate
-         the next position of the particle and we append the new position to each particle's path list.
-        -After obtaining the new position, we call updateParticle() to do further localization and mapping.
+        -in this funciton, we draw one noisy move for every particle at once from self.motionTable (see
+         buildMotionTable()) and we append the new position to each particle's trajectory.
+        -After obtaining the new positions, we weight the particles against ranges with weightParticles(),
+         before their maps have seen this reading, then call updateParticle() to do further localization
+         and mapping. Particles with importance 0 are skipped: the next resampling drops them, unless every
+         particle has died, and then their maps simply miss the readings in between.
         """
+        outcomes = self.motionTable[i]
+        moves = [outcomes[int(random.random()*MOTION_NOISE_STEPS)] for p in self.particles]
+        for p, move in zip(self.particles, moves):
+            p.move(move[p.getPosition()])
+        if self.sonarWeighting:
+            self.weightParticles(ranges)
         for p in self.particles:
-            # print p.path
-            last = p.path[-1]
-            new = copy.deepcopy(last)
-            # Add motion noise:
-            reserved = new
-            new = list(new)
-            ## randomnized
-            new = self.rand(i, new)                                            
-            new = tuple(new)
-            if (new[1] not in range(self.layoutHeight)) or (new[0] not in range(self.layoutWidth)):
-                new = reserved
-            p.path.append(new)
             # Update this particle:
-            self.updateParticle(p, ranges)
+            if p.importance != 0:
+                self.updateParticle(p, ranges)
 
 
-    def ratio(self, particle):
+    def expectedRanges(self, particle):
         """
-        -parameters: this function takes in one particle
-        -this helper function returns the ratio of 1-(all the position pacman has been to/all the positions pacman can be in).
-        -the function is called in updateParticle because we decide to lower particle's ability to decrease his preception of
-         walls over time. (at time step 1000, if pacman detects a wall, it will only add a tiny bit of weight to the wall position) 
+        -returns, for each direction of RAY_DIRECTIONS, the number of steps from the particle's position to
+         the first cell its map believes is more likely a wall than not (positive log-odds); past the edge of
+         the layout counts as wall.
         """
-        rt = 1-len(set(particle.path))/(self.layoutWidth*self.layoutHeight-round(self.wallPrior*self.layoutWidth*self.layoutHeight, 0))
-        if rt<=0:
-            rt=0.01
-        return rt
+        x, y = particle.getPosition()
+        reaches = [self.layoutHeight - 1 - y, self.layoutWidth - 1 - x, y, x]
+        expected = []
+        for i in range(4):
+            start, stop, step = self.rayCells((x, y), i, reaches[i] + 1)
+            values = self.maps.getCells(particle.mapIndex, start, stop, step)
+            # Slices run towards higher cell indices, i.e. away from Pacman only to the north and east
+            if i < 2:
+                values = values[1:]
+            else:
+                values = values[-2::-1]
+            distance = len(values) + 1
+            for k, value in enumerate(values):
+                if value > 0:
+                    distance = k + 1
+                    break
+            expected.append(distance)
+        return expected
+
+
+    def weightParticles(self, ranges):
+        """
+        -multiplies every particle's importance by the likelihood of the four readings in ranges given the
+         ranges its own map expects (expectedRanges()), gathered from self.sonarLogLikelihoods, a
+         slam.ObservationTable, for all particles at once per direction. The log-likelihoods are shifted by
+         their maximum before exponentiating, so no weight underflows.
+        -importances are then rescaled to sum to numParticles, which leaves effectiveSampleSize() unchanged.
+         Particles with importance 0 keep it.
+        """
+        table = self.sonarLogLikelihoods
+        alive = [p for p in self.particles if p.importance != 0]
+        if not alive:
+            return
+        expected = zip(*[self.expectedRanges(p) for p in alive])
+        scores = [table.gatherLogLikelihoods(ranges[i], expected[i]) for i in range(4)]
+        logWeights = map(sum, zip(*scores))
+        best = max(logWeights)
+        total = 0.0
+        for p, w in zip(alive, logWeights):
+            p.importance *= math.exp(w - best)
+            total += p.importance
+        if total > 0:
+            scale = len(self.particles) / total
+            for p in self.particles:
+                p.importance *= scale
+
+
+    def rayCells(self, pos, direction, length):
+        """
+        -parameters: pos is where the sonar is fired from, direction indexes RAY_DIRECTIONS and length is
+         the number of cells the ray passes through (pos itself included).
+        -returns (start, stop, step) such that the cell indices start:stop:step (see self.maps.cellIndex)
+         are those cells, cut off at the edge of the layout.
+        """
+        x, y = pos
+        H = self.layoutHeight
+        if direction == 0:
+            length = min(length, H - y)
+            start, step = x*H + y, 1
+        elif direction == 1:
+            length = min(length, self.layoutWidth - x)
+            start, step = x*H + y, H
+        elif direction == 2:
+            length = min(length, y + 1)
+            start, step = x*H + y - length + 1, 1
+        else:
+            length = min(length, x + 1)
+            start, step = (x - length + 1)*H + y, H
+        if length <= 0:
+            return start, start, step
+        return start, start + (length - 1)*step + 1, step
 
 
     def updateParticle(self, particle, ranges):
         """
         -parameters: particle is the particle that is being updated, ranges is the range measurement
-        -First, we decrease the wall probability of all the position that are inside our range. 
-        -Second, we increase the wall probability and importance(resampling criteria, more on that later) of 
-         all the position that are at our range. 
-        -If the particle we are updating is out of range, we set its importance(will explain in 
+        -Maps hold the log-odds of walls, so evidence is simply added: first, we add LOG_ODDS_FREE to all the
+         position that are inside our range; second, we add self.logOddsHit to the position that is at our
+         range, unless the range is 0. Both come from the sonar noise model (see the top of this file) and
+         need no clamping.
+        -If the particle we are updating is out of range, we set its importance(its weight, will explain in 
          resampleParticles() function) to 0.
-        -We times all the weight with self.ratio(), helper function defined above.
+        -The particle's map is map particle.mapIndex of self.maps, made writable first; each sonar ray is
+         updated with one self.maps.addToCells call over its cells, as given by rayCells().
         """
-        pacman_pos = (particle.path[-1][0], particle.path[-1][1])
+        particle.mapIndex = self.maps.writable(particle.mapIndex)
+        mapIndex = particle.mapIndex
+        pacman_pos = particle.getPosition()
         for i in range(4):
-            for ii in range(ranges[i]):
-                if i==0:
-                    particle.walls[pacman_pos[0], pacman_pos[1]+ii]-=self.ratio(particle)*0.3
-                    if particle.walls[pacman_pos[0], pacman_pos[1]+ii] < 0:
-                        particle.walls[pacman_pos[0], pacman_pos[1]+ii] = 0
-                elif i==1:
-                    particle.walls[pacman_pos[0]+ii, pacman_pos[1]]-=self.ratio(particle)*0.3
-                    if particle.walls[pacman_pos[0]+ii, pacman_pos[1]] < 0:
-                        particle.walls[pacman_pos[0]+ii, pacman_pos[1]] = 0
-                elif i==2:
-                    particle.walls[pacman_pos[0], pacman_pos[1]-ii]-=self.ratio(particle)*0.3
-                    if particle.walls[pacman_pos[0], pacman_pos[1]-ii] < 0:
-                        particle.walls[pacman_pos[0], pacman_pos[1]-ii] = 0
-                else:
-                    particle.walls[pacman_pos[0]-ii, pacman_pos[1]]-=self.ratio(particle)*0.3
-                    if particle.walls[pacman_pos[0]-ii, pacman_pos[1]] < 0:
-                        particle.walls[pacman_pos[0]-ii, pacman_pos[1]] = 0
-
-            if i==0:
-                wallpos = (pacman_pos[0],pacman_pos[1]+ranges[i])
-            elif i==1:
-                wallpos = (pacman_pos[0]+ranges[i],pacman_pos[1])
-            elif i==2:
-                wallpos = (pacman_pos[0],pacman_pos[1]-ranges[i])
-            else:
-                wallpos = (pacman_pos[0]-ranges[i],pacman_pos[1])
+            start, stop, step = self.rayCells(pacman_pos, i, ranges[i])
+            self.maps.addToCells(mapIndex, start, stop, step, LOG_ODDS_FREE)
 
-            particle.walls[wallpos] += 0.1*self.ratio(particle)
-            if particle.walls[wallpos] > 1:
-                particle.walls[wallpos] = 1
+            dx, dy = RAY_DIRECTIONS[i]
+            wallX = pacman_pos[0] + dx*ranges[i]
+            wallY = pacman_pos[1] + dy*ranges[i]
+            if 0 <= wallX < self.layoutWidth and 0 <= wallY < self.layoutHeight:
+                if ranges[i] > 0:
+                    self.maps.addToCell(mapIndex, wallX*self.layoutHeight + wallY, self.logOddsHit)
+            else:
+                particle.importance = 0
+                break
 
 
-            if i==0:
-                if (pacman_pos[1]+ranges[0]) in range(self.layoutHeight):
-                    particle.importance += 0.25
-                else:
-                    particle.importance = 0
-                    break
-            if i==1:
-                if (pacman_pos[0]+ranges[1]) in range(self.layoutWidth):
-                    particle.importance += 0.25
-                else:
-                    particle.importance = 0
-                    break
-            if i==2:
-                if (pacman_pos[1]-ranges[2]) in range(self.layoutHeight):
-                    particle.importance += 0.25
-                else:
-                    particle.importance = 0
-                    break
-            if i==3:
-                if (pacman_pos[0]-ranges[3]) in range(self.layoutWidth):
-                    particle.importance += 0.25
-                else:
-                    particle.importance = 0
-                    break
+    def effectiveSampleSize(self):
+        """
+        -returns (sum of importances)^2 / (sum of squared importances), i.e. how many equally weighted
+         particles our weighted particles are worth. With importances of 0 and 1 it is the number of
+         particles that are still alive.
+        """
+        total = 0.0
+        totalSquares = 0.0
+        for p in self.particles:
+            total += p.importance
+            totalSquares += p.importance*p.importance
+        if totalSquares == 0:
+            return 0.0
+        return total*total/totalSquares
 
 
     def resampleParticles(self):
         """
-        -We resample all our particles in this function. 
-        -All particles has either a self.importance value of 0 or 1. If they have importance of 1, we add it to the newparticles list
-         we then throw out the particles with self.importance = 0, and duplicate good particles until we have numParticles particles in
-         our newparticles list.
-        -If all our particles appears to have a self.importance of 0, we initialize the particles list by setting all the particles'
-         importance to 1.
+        -We resample all our particles in this function using systematic (low-variance) resampling: we lay
+         numParticles evenly spaced pointers, with one random offset, over the cumulative importances and
+         take the particle under each pointer. This is O(numParticles) and a particle with importance w is
+         picked either floor or ceil of N*w/total times, so we lose less diversity than with independent draws.
+        -Particles with importance 0 are never picked. After resampling all importances are reset to 1.
+        -If all our particles appears to have a self.importance of 0, we keep the particles and set all the
+         particles' importance to 1.
+        -A particle picked once is kept as it is and further picks share its map until they write to it, so
+         resampling copies no maps.
         """
         N = len(self.particles)
+        total = float(sum(p.importance for p in self.particles))
+        if total == 0:
+            for p in self.particles:
+                p.importance = 1
+            return
+        step = total / N
+        pointer = random.random() * step
+        cumulative = 0.0
         newparticles = []
-        cop = []
-        for i in range(N):
-            particle = self.particles[i]
-            if particle.importance>=1:
-                cop.append(copy.deepcopy(particle))
-                newparticles.append(copy.deepcopy(particle))
-        while len(newparticles)<N:
-            indicator = False
-            for i in range(len(cop)):
-                if len(newparticles) >= N:
-                    indicator = True
-                    break
-                destiny = random.random()
-                newparticles.append(copy.deepcopy(cop[i]))            ## need to add new filtered particles
-            if len(cop)==0:
-                newparticles = copy.deepcopy(self.particles)
-                for p in newparticles:
-                    p.importance = 1
-            if indicator:
-                break
+        for p in self.particles:
+            cumulative += p.importance
+            picked = False
+            while pointer < cumulative and len(newparticles) < N:
+                if picked:
+                    newparticles.append(p.copy(self.maps))
+                else:
+                    newparticles.append(p)
+                    picked = True
+                pointer += step
+            if not picked:
+                self.maps.release(p.mapIndex)
+        while len(newparticles) < N:
+            # Floating point round-off can leave the last pointer just past the final cumulative sum
+            newparticles.append(newparticles[-1].copy(self.maps))
+        for p in newparticles:
+            p.importance = 1
         self.particles = newparticles
 
     
+    def getBestPath(self):
+        """
+        Returns the trajectory of the particle with the highest importance, extracted from the ancestry
+        tree on demand.
+        """
+        best = max(self.particles, key=lambda p: p.importance)
+        return best.getPath()
+
+
     def getWallBeliefDistribution(self):
         """
-        We took all our Particle objects, build a new global counter every time, and add every particles' map and beliefs into 
-        self.walls and divide the value by numParticles to a distribution of walls.
+        We take the sum of every particles' map weighted by its importance (see weighMaps()), which
+        self.maps keeps up to date with the writes and brings up to date with the weights since the last
+        call, and divide the value by the total importance to a distribution of walls. The sum is kept
+        incrementally, so it is clamped to [0, 1] against round-off. If every particle has importance 0,
+        every cell gets the wall prior.
         """        
         self.walls=util.Counter()
-        N = len(self.particles)
-        for i in range(N):
-            for legalPosition in self.legalPositions:
-                self.walls[legalPosition]+=self.particles[i].walls[legalPosition]
+        self.weighMaps()
+        sums = self.maps.totals
+        total = float(sum(p.importance for p in self.particles))
         for legalPosition in self.legalPositions:
-            self.walls[legalPosition] /= float(self.numParticles)
+            if total > 0:
+                belief = sums[self.maps.cellIndex(legalPosition)] / total
+            else:
+                belief = self.wallPrior
+            self.walls[legalPosition] = min(1.0, max(0.0, belief))
         return self.walls
     
 
@@ -348,7 +962,8 @@ class SLAMParticleFilter(InferenceModule):
         pos=util.Counter()
         N = len(self.particles)
         for i in range(N):
-            pos[self.particles[i].path[-1]] += (self.particles[i].importance)*(1-self.walls[self.particles[i].path[-1]])
+            position = self.particles[i].getPosition()
+            pos[position] += (self.particles[i].importance)*(1-self.walls[position])
         for i in range(self.layoutWidth):
             pos[(i,0)]=0
             pos[(i,self.layoutHeight-1)]=0
@@ -356,4 +971,331 @@ class SLAMParticleFilter(InferenceModule):
             pos[(0,j)]=0
             pos[(self.layoutWidth-1, j)]=0
         pos.normalize()
-        return pos
\ No newline at end of file
+        return pos
+
+
+class FastSLAMParticleFilter(SLAMParticleFilter):
+    """
+    SLAMParticleFilter with FastSLAM-style map sharing: the particles' maps
+    are kept in a MapTileTree, so resampling only moves references and an
+    update copies O(log tiles) tree nodes and the tiles it touches, instead
+    of a whole map. Memory then grows with the parts of the maps particles
+    actually disagree on, which lets particle counts reach the thousands.
+    The filter itself behaves exactly like SLAMParticleFilter.
+    """
+    mapStoreClass = MapTileTree
+
+
+def getCellMoves(walls):
+    """
+    Returns the change of cell index (x*height + y order) each action makes, and for every cell the
+    actions legal there (none for walls), as the game computes them.
+    """
+    H = walls.height
+    shifts = {Directions.NORTH: 1, Directions.SOUTH: -1, Directions.EAST: H, Directions.WEST: -H,
+              Directions.STOP: 0}
+    legal = []
+    for x in range(walls.width):
+        for y in range(H):
+            if walls[x][y]:
+                legal.append([])
+            else:
+                legal.append(game.Actions.getPossibleActions(game.Configuration((x, y), Directions.STOP), walls))
+    return shifts, legal
+
+class KnownMapInference(InferenceModule):
+    """
+    Base class of the inference modules that localize Pacman on the true walls, given to them up front,
+    instead of mapping them: HistogramFilter and MonteCarloLocalizer. freeCells holds 1.0 for every cell
+    that is not a wall and 0.0 for the walls, in the x*height + y order of ParticleMapStore.
+    """
+
+    # Tells SLAMAgent that this module must be given the true walls (the walls keyword argument)
+    usesKnownMap = True
+
+    def __init__(self, layoutWidth, layoutHeight, legalPositions, walls):
+        if walls == None:
+            raise Exception(self.__class__.__name__ + ' needs the true walls')
+        self.walls = walls
+        self.legalPositions = legalPositions
+        self.layoutWidth = layoutWidth
+        self.layoutHeight = layoutHeight
+        self.numCells = layoutWidth * layoutHeight
+        self.freeCells = array.array('d', [0.0 if walls[x][y] else 1.0
+                                           for x in range(layoutWidth) for y in range(layoutHeight)])
+
+
+    def getWallBeliefDistribution(self):
+        "The walls are known."
+        beliefs = util.Counter()
+        for x, y in self.legalPositions:
+            beliefs[(x, y)] = 1.0 if self.walls[x][y] else 0.0
+        return beliefs
+
+
+class HistogramFilter(KnownMapInference):
+    """
+    Exact Bayesian localization on a known map: the belief over Pacman's position is one probability per
+    cell, in the x*height + y order of ParticleMapStore, updated in full at every step. It is the exact
+    answer particle filters approximate, to benchmark them against; it does no mapping.
+    """
+
+    def __init__(self, startPos, layoutWidth, layoutHeight, wallPrior, legalPositions, walls=None):
+        """
+        -walls is the Grid of true walls, required.
+        -The belief starts on startPos, which Pacman knows.
+        -The sonar likelihood of every cell comes from its true ranges (layout.computeWallRanges) and
+         slam.getSonarReadingTable, and the motion model from buildMotionCoefficients().
+        """
+        KnownMapInference.__init__(self, layoutWidth, layoutHeight, legalPositions, walls)
+        self.trueRanges = layout.computeWallRanges(walls)
+        self.sonarTable = slam.getSonarReadingTable(max(layoutWidth, layoutHeight))
+        self.belief = array.array('d', [0.0]) * self.numCells
+        self.belief[startPos[0] * layoutHeight + startPos[1]] = 1.0
+        self.buildMotionCoefficients()
+
+
+    def buildMotionCoefficients(self):
+        """
+        -The game executes an attempted action a with probability Actions.CORRECT_ACTION_PROB and
+         otherwise one of the legal actions (STOP included) uniformly at random, so from cell c Pacman
+         makes move b with probability CORRECT_ACTION_PROB*[b==a] + (1-CORRECT_ACTION_PROB)/|legal(c)|
+         for every b legal at c. Cells where a is illegal cannot be where Pacman attempted a.
+        -We precompute self.motionCoefficients[a] as a list of (shift, coefficients) pairs, one per move b:
+         shift is the change of cell index b makes and coefficients holds that probability for every
+         cell, so that predicting is a sum of shifted products.
+        """
+        shifts, legal = getCellMoves(self.walls)
+        correct = game.Actions.CORRECT_ACTION_PROB
+        self.motionCoefficients = {}
+        for a in shifts:
+            pairs = []
+            for b in shifts:
+                coefficients = array.array('d', [0.0]) * self.numCells
+                for cell in range(self.numCells):
+                    if a in legal[cell] and b in legal[cell]:
+                        coefficients[cell] = (1 - correct) / len(legal[cell]) + (correct if a == b else 0.0)
+                pairs.append((shifts[b], coefficients))
+            self.motionCoefficients[a] = pairs
+
+
+    def elapseTime(self, prevAction):
+        "Predicts the belief after Pacman attempted prevAction (None before his first move)."
+        if prevAction == None:
+            return
+        n = self.numCells
+        predicted = array.array('d', [0.0]) * n
+        for shift, coefficients in self.motionCoefficients[prevAction]:
+            moved = map(operator.mul, self.belief, coefficients)
+            # Legal moves never leave the layout, so nothing shifted past either end is lost
+            if shift > 0:
+                moved = [0.0] * shift + moved[:n - shift]
+            elif shift < 0:
+                moved = moved[-shift:] + [0.0] * -shift
+            predicted = array.array('d', map(operator.add, predicted, moved))
+        self.belief = predicted
+
+
+    def observe(self, prevAction, ranges):
+        """
+        -Predicts with elapseTime(), then multiplies the belief by the likelihood of each of the four
+         readings at every cell, gathered from the sonar table in one lookup per direction, and normalizes.
+        -If no cell the belief allows explains the readings, the belief restarts from the likelihood of the
+         readings at every free cell, or from every free cell if none explains them either.
+        """
+        self.elapseTime(prevAction)
+        likelihoods = [1.0] * self.numCells
+        for i in range(4):
+            likelihoods = map(operator.mul, likelihoods, self.sonarTable.gatherLikelihoods(ranges[i], self.trueRanges[i]))
+        belief = map(operator.mul, self.belief, likelihoods)
+        total = sum(belief)
+        if total == 0:
+            belief = map(operator.mul, self.freeCells, likelihoods)
+            total = sum(belief)
+        if total == 0:
+            belief = list(self.freeCells)
+            total = sum(belief)
+        self.belief = array.array('d', [b / total for b in belief])
+
+
+    def getPositionBeliefDistribution(self):
+        beliefs = util.Counter()
+        H = self.layoutHeight
+        for cell, b in enumerate(self.belief):
+            if b > 0:
+                beliefs[(cell / H, cell % H)] = b
+        return beliefs
+
+
+class MonteCarloLocalizer(KnownMapInference):
+    """
+    Particle filter localization on a known map (Monte Carlo Localization): particles are only positions,
+    so a step is a few whole-array operations and large particle counts stay cheap.
+
+    Particles live in self.cells, an array('i') of cell indices in the x*height + y order, with their
+    weights in self.weights. One extra cell index, deadCell, holds particles that turned out impossible;
+    it never moves and its sonar likelihood is 0.
+    """
+
+    # Slots of a motion draw: Actions.CORRECT_ACTION_PROB of them follow the attempted action and the
+    # rest are split evenly among the legal actions, so there should be a multiple of 60 (every possible
+    # count of those, 1 to 5, divides it) left over for that
+    MOTION_SLOTS = 600
+
+    def __init__(self, startPos, layoutWidth, layoutHeight, wallPrior, legalPositions, walls=None,
+                 numParticles=1000, resampleThreshold=0.5):
+        """
+        -walls is the Grid of true walls, required. All particles start on startPos, which Pacman knows.
+        -resampleThreshold: resample once the effective sample size drops below
+         resampleThreshold*numParticles, as in SLAMParticleFilter.
+        """
+        KnownMapInference.__init__(self, layoutWidth, layoutHeight, legalPositions, walls)
+        self.numParticles = numParticles
+        self.resampleThreshold = resampleThreshold
+        self.deadCell = self.numCells
+        self.trueRanges = [ranges + [0] for ranges in layout.computeWallRanges(walls)]
+        self.sonarTable = slam.getSonarReadingTable(max(layoutWidth, layoutHeight))
+        self.cells = array.array('i', [startPos[0] * layoutHeight + startPos[1]]) * numParticles
+        self.weights = array.array('d', [1.0 / numParticles]) * numParticles
+        self.buildMotionTables()
+
+
+    def buildMotionTables(self):
+        """
+        -self.intendedMoves[a][cell] is where attempting a from cell leads, and deadCell where a is not
+         legal, since Pacman only attempts legal actions.
+        -self.noiseMoves[cell*noiseSlots + j] spreads the noiseSlots noisy outcomes evenly over the
+         legal actions at cell.
+        -Taking the intended move with probability correctSlots/MOTION_SLOTS and otherwise a uniformly
+         drawn noise slot moves a particle exactly as Actions.getNoisyAction does.
+        """
+        self.correctSlots = int(round(game.Actions.CORRECT_ACTION_PROB * self.MOTION_SLOTS))
+        self.noiseSlots = self.MOTION_SLOTS - self.correctSlots
+        shifts, legal = getCellMoves(self.walls)
+        legal.append([])
+        dead = self.deadCell
+        self.intendedMoves = {}
+        for a, shift in shifts.items():
+            self.intendedMoves[a] = array.array('i', [cell + shift if a in legal[cell] else dead
+                                                      for cell in range(self.numCells + 1)])
+        slots = self.noiseSlots
+        self.noiseMoves = array.array('i', [dead]) * ((self.numCells + 1) * slots)
+        for cell in range(self.numCells):
+            moves = legal[cell]
+            for j in range(slots):
+                if moves:
+                    self.noiseMoves[cell * slots + j] = cell + shifts[moves[j * len(moves) / slots]]
+
+
+    def elapseTime(self, prevAction):
+        """
+        Moves every particle with the noisy action model; prevAction is None before Pacman's first move.
+        All particles first take their intended move, gathered in one operator.itemgetter call. The
+        particles whose draw is noisy are then found by skipping geometrically distributed gaps, so only
+        those (a tenth of them) are visited one by one to take one of the noise slots.
+        """
+        if prevAction == None:
+            return
+        cells = self.cells
+        N = self.numParticles
+        moved = list(operator.itemgetter(*cells)(self.intendedMoves[prevAction])) if N > 1 \
+            else [self.intendedMoves[prevAction][cells[0]]]
+        noise, slots, dead = self.noiseMoves, self.noiseSlots, self.deadCell
+        logCorrect = math.log(float(self.correctSlots) / self.MOTION_SLOTS)
+        r, log = random.random, math.log
+        i = int(log(1.0 - r()) / logCorrect)
+        while i < N:
+            if moved[i] != dead:
+                moved[i] = noise[cells[i] * slots + int(r() * slots)]
+            i += int(log(1.0 - r()) / logCorrect) + 1
+        self.cells = array.array('i', moved)
+
+
+    def getCellLikelihoods(self, ranges):
+        "The likelihood of ranges at every cell (and 0 at deadCell), from one gathered table row per direction."
+        likelihoods = [1.0] * (self.numCells + 1)
+        for i in range(4):
+            likelihoods = map(operator.mul, likelihoods,
+                              self.sonarTable.gatherLikelihoods(ranges[i], self.trueRanges[i]))
+        likelihoods[self.deadCell] = 0.0
+        return likelihoods
+
+
+    def observe(self, prevAction, ranges):
+        """
+        -Moves the particles with elapseTime(), then multiplies each weight by the sonar likelihood of its
+         cell, gathered for all particles in one operator.itemgetter call, and normalizes.
+        -If every weight is 0 the particles are drawn again from the cells that explain ranges.
+        -Resamples once the effective sample size is below resampleThreshold*numParticles.
+        """
+        self.elapseTime(prevAction)
+        likelihoods = self.getCellLikelihoods(ranges)
+        gathered = operator.itemgetter(*self.cells)(likelihoods)
+        if self.numParticles == 1:
+            gathered = (gathered,)
+        weights = map(operator.mul, self.weights, gathered)
+        total = sum(weights)
+        if total == 0:
+            self.reinitialize(likelihoods)
+            return
+        self.weights = array.array('d', [w / total for w in weights])
+        if self.effectiveSampleSize() < self.resampleThreshold * self.numParticles:
+            self.resampleParticles()
+
+
+    def reinitialize(self, likelihoods):
+        """
+        Draws every particle afresh from the free cells in proportion to their likelihoods, or from every
+        free cell if none explains the readings. Walls are left out: their true ranges are all 0, so a
+        reading of (0, 0, 0, 0) would otherwise put the particles there.
+        """
+        free = list(self.freeCells) + [0.0]
+        likelihoods = map(operator.mul, likelihoods, free)
+        if sum(likelihoods) == 0:
+            likelihoods = free
+        sampler = util.DiscreteSampler(likelihoods, range(len(likelihoods)))
+        self.cells = array.array('i', sampler.nSample(self.numParticles))
+        self.weights = array.array('d', [1.0 / self.numParticles]) * self.numParticles
+
+
+    def effectiveSampleSize(self):
+        "1 / (sum of squared weights), for weights that sum to 1."
+        squares = sum(map(operator.mul, self.weights, self.weights))
+        if squares == 0:
+            return 0.0
+        return 1.0 / squares
+
+
+    def resampleParticles(self):
+        """
+        Systematic resampling, as in SLAMParticleFilter: numParticles evenly spaced pointers with one
+        random offset. A particle gets as many copies as pointers fall within its share of the cumulative
+        weights (a difference of floors, offset by one so the floors are of positive numbers), and the
+        copies are laid out by itertools.repeat. Weights are reset to uniform.
+        """
+        N = self.numParticles
+        scale = N / sum(self.weights)
+        ends = []
+        append = ends.append
+        end = 1.0 - random.random()
+        for w in self.weights:
+            end += w * scale
+            append(end)
+        ends = map(int, ends)
+        ends[-1] = N
+        copies = itertools.imap(operator.sub, ends, [0] + ends[:-1])
+        resampled = list(itertools.chain.from_iterable(itertools.imap(itertools.repeat, self.cells, copies)))
+        self.cells = array.array('i', resampled[:N])
+        self.weights = array.array('d', [1.0 / N]) * N
+
+
+    def getPositionBeliefDistribution(self):
+        totals = [0.0] * (self.numCells + 1)
+        for cell, w in zip(self.cells, self.weights):
+            totals[cell] += w
+        beliefs = util.Counter()
+        H = self.layoutHeight
+        for cell in range(self.numCells):
+            if totals[cell] > 0:
+                beliefs[(cell / H, cell % H)] = totals[cell]
+        return beliefs
@@ -14,28 +14,35 @@
 
 
 from util import manhattanDistance
-from game import Grid
+from game import Grid, BitGrid
 import os
 import random
 
 VISIBILITY_MATRIX_CACHE = {}
+WALL_RANGES_CACHE = {}
 
 class Layout:
     """
     A Layout manages the static information about the game board.
+
+    A Layout is treated as immutable once built: game states and their deep
+    copies all share the same instance, so per-layout tables (such as the
+    wall ranges) are computed once and kept on it.
     """
 
-    def __init__(self, layoutText):
+    def __init__(self, layoutText, name=None):
+        self.name = name
         self.width = len(layoutText[0])
         self.height= len(layoutText)
-        self.walls = Grid(self.width, self.height, False)
-        self.food = Grid(self.width, self.height, False)
+        self.walls = BitGrid(self.width, self.height, False)
+        self.food = BitGrid(self.width, self.height, False)
         self.capsules = []
         self.agentPositions = []
         self.numGhosts = 0
         self.processLayoutText(layoutText)
         self.layoutText = layoutText
         self.totalFood = len(self.food.asList())
+        self.wallRanges = None
         # self.initializeVisibilityMatrix()
 
     def getNumGhosts(self):
@@ -62,6 +69,19 @@ class Layout:
         else:
             self.visibility = VISIBILITY_MATRIX_CACHE[reduce(str.__add__, self.layoutText)]
 
+    def getWallRanges(self):
+        """
+        Returns the true distance to the nearest wall from every cell in each
+        of the four directions (see computeWallRanges). The table is built
+        once per layout text and shared by every Layout with that text.
+        """
+        if self.wallRanges == None:
+            key = tuple(self.layoutText)
+            if key not in WALL_RANGES_CACHE:
+                WALL_RANGES_CACHE[key] = computeWallRanges(self.walls)
+            self.wallRanges = WALL_RANGES_CACHE[key]
+        return self.wallRanges
+
     def isWall(self, pos):
         x, col = pos
         return self.walls[x][col]
@@ -91,7 +111,8 @@ class Layout:
         return "\n".join(self.layoutText)
 
     def deepCopy(self):
-        return Layout(self.layoutText[:])
+        "Re-parses the layout text into a new, independent Layout."
+        return Layout(self.layoutText[:], self.name)
 
     def processLayoutText(self, layoutText):
         """
@@ -129,6 +150,41 @@ class Layout:
         elif layoutChar in  ['1', '2', '3', '4']:
             self.agentPositions.append( (int(layoutChar), (x,y)))
             self.numGhosts += 1
+def computeWallRanges(walls):
+    """
+    Returns four lists (N, E, S, W) such that ranges[d][x * walls.height + y]
+    is the number of steps from (x,y) to the first wall in direction d, or 0
+    if (x,y) is itself a wall. Anything beyond the edge of the grid counts as
+    wall. Each direction is a single sweep over the grid.
+    """
+    width, height = walls.width, walls.height
+    north, east, south, west = [[0] * (width * height) for i in range(4)]
+    for x in range(width):
+        column = walls[x]
+        base = x * height
+        reach = 1
+        for y in range(height - 1, -1, -1):
+            if column[y]: reach = 0
+            else: north[base + y] = reach
+            reach += 1
+        reach = 1
+        for y in range(height):
+            if column[y]: reach = 0
+            else: south[base + y] = reach
+            reach += 1
+    for y in range(height):
+        reach = 1
+        for x in range(width - 1, -1, -1):
+            if walls[x][y]: reach = 0
+            else: east[x * height + y] = reach
+            reach += 1
+        reach = 1
+        for x in range(width):
+            if walls[x][y]: reach = 0
+            else: west[x * height + y] = reach
+            reach += 1
+    return [north, east, south, west]
+
 def getLayout(name, back = 2):
     if name.endswith('.lay'):
         layout = tryToLoad('layouts/' + name)
@@ -146,5 +202,5 @@ def getLayout(name, back = 2):
 def tryToLoad(fullname):
     if(not os.path.exists(fullname)): return None
     f = open(fullname)
-    try: return Layout([line.strip() for line in f])
+    try: return Layout([line.strip() for line in f], os.path.splitext(os.path.basename(fullname))[0])
     finally: f.close()
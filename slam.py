@@ -36,7 +36,7 @@ from game import Actions
 from game import Configuration
 from util import nearestPoint
 from util import manhattanDistance
-import sys, util, types, time, random, layout, os
+import sys, util, types, time, random, layout, os, array, math, operator
 
 ########################################
 # Parameters for noisy sensor readings #
@@ -47,10 +47,24 @@ SONAR_MAX = (SONAR_NOISE_RANGE - 1)/2
 SONAR_NOISE_VALUES = [i - SONAR_MAX for i in range(SONAR_NOISE_RANGE)]
 SONAR_DENOMINATOR = 2 ** SONAR_MAX  + 2 ** (SONAR_MAX + 1) - 2.0
 SONAR_NOISE_PROBS = [2 ** (SONAR_MAX-abs(v)) / SONAR_DENOMINATOR  for v in SONAR_NOISE_VALUES]
+SONAR_NOISE_SAMPLER = util.DiscreteSampler(SONAR_NOISE_PROBS, SONAR_NOISE_VALUES)
 
 def getNoisyDistance(pos1, pos2):
-    distance = util.manhattanDistance(pos1, pos2)
-    return max(0, min(distance, distance + util.sample(SONAR_NOISE_PROBS, SONAR_NOISE_VALUES)))
+    return addSonarNoise(util.manhattanDistance(pos1, pos2))
+
+def addSonarNoise(distance):
+    "Returns a noisy sonar reading of a wall that is distance away."
+    return max(0, min(distance, distance + SONAR_NOISE_SAMPLER.sample()))
+
+def addSonarNoiseToAll(distances, rng=random):
+    """
+    Returns noisy sonar readings for a whole batch of true distances,
+    drawing all of the noise from rng with one call to the sampler, in
+    the order of the distances: the same readings as addSonarNoise on
+    each in turn with the same random numbers.
+    """
+    noise = SONAR_NOISE_SAMPLER.nSample(len(distances), rng)
+    return [max(0, min(d, d + e)) for d, e in zip(distances, noise)]
 
 observationDistributions = {}
 def getObservationDistribution(noisyDistance):
@@ -68,6 +82,83 @@ def getObservationDistribution(noisyDistance):
         observationDistributions[noisyDistance] = distribution
     return observationDistributions[noisyDistance]
 
+class ObservationTable:
+    """
+    A dense table of the likelihoods P( noisy | true ) of a noisy distance
+    given a true distance, for 0 <= noisy <= maxNoisy and 0 <= true <= maxTrue:
+    likelihoods[noisy] and logLikelihoods[noisy] are arrays indexed by true
+    distance (log-likelihoods are -inf where the likelihood is 0).
+
+    The gather methods look up a whole list of true distances at once, with
+    one operator.itemgetter call instead of a lookup per distance.
+    """
+    def __init__(self, likelihoods):
+        self.maxNoisy = len(likelihoods) - 1
+        self.maxTrue = len(likelihoods[0]) - 1
+        self.likelihoods = [array.array('d', row) for row in likelihoods]
+        self.logLikelihoods = [array.array('d', [math.log(l) if l > 0 else float('-inf') for l in row])
+                               for row in likelihoods]
+
+    def _gather(self, row, trueDistances):
+        if len(trueDistances) == 0:
+            return []
+        if len(trueDistances) == 1:
+            return [row[trueDistances[0]]]
+        return list(operator.itemgetter(*trueDistances)(row))
+
+    def gatherLikelihoods(self, noisy, trueDistances):
+        "Returns [P( noisy | true ) for true in trueDistances]; all must be within the table."
+        return self._gather(self.likelihoods[noisy], trueDistances)
+
+    def gatherLogLikelihoods(self, noisy, trueDistances):
+        "Returns [log P( noisy | true ) for true in trueDistances]; all must be within the table."
+        return self._gather(self.logLikelihoods[noisy], trueDistances)
+
+    def mixedWithUniform(self, uniformProb):
+        """
+        Returns the table of (1 - uniformProb) * P( noisy | true ) plus
+        uniformProb spread evenly over the noisy distances.
+        """
+        uniform = uniformProb / (self.maxNoisy + 1)
+        return ObservationTable([[(1 - uniformProb) * l + uniform for l in row] for row in self.likelihoods])
+
+observationTables = {}
+def getObservationTable(maxDistance):
+    """
+    Returns an ObservationTable agreeing with getObservationDistribution for
+    every noisy distance up to maxDistance; true distances go up to
+    maxDistance + SONAR_MAX, beyond which the likelihood is always 0.
+    """
+    if maxDistance not in observationTables:
+        likelihoods = [[0.0] * (maxDistance + SONAR_MAX + 1) for noisy in range(maxDistance + 1)]
+        for noisy in range(maxDistance + 1):
+            for error, prob in zip(SONAR_NOISE_VALUES, SONAR_NOISE_PROBS):
+                likelihoods[noisy][max(1, noisy - error)] += prob
+        observationTables[maxDistance] = ObservationTable(likelihoods)
+    return observationTables[maxDistance]
+
+sonarReadingTables = {}
+def getSonarReadingTable(maxDistance, maxTrue=None):
+    """
+    Returns an ObservationTable of the likelihood of a range reading up to
+    maxDistance given the true distance to the wall, up to maxTrue
+    (maxDistance by default), for readings made by addSonarNoise. Those
+    never overshoot the wall, unlike the noise assumed by
+    getObservationDistribution.
+    """
+    if maxTrue == None:
+        maxTrue = maxDistance
+    key = (maxDistance, maxTrue)
+    if key not in sonarReadingTables:
+        likelihoods = [[0.0] * (maxTrue + 1) for noisy in range(maxDistance + 1)]
+        for true in range(maxTrue + 1):
+            for error, prob in zip(SONAR_NOISE_VALUES, SONAR_NOISE_PROBS):
+                noisy = max(0, min(true, true + error))
+                if noisy <= maxDistance:
+                    likelihoods[noisy][true] += prob
+        sonarReadingTables[key] = ObservationTable(likelihoods)
+    return sonarReadingTables[key]
+
 ###################################################
 # YOUR INTERFACE TO THE PACMAN WORLD: A GameState #
 ###################################################
@@ -230,28 +321,17 @@ class GameState:
         """
         Return a noisy measurement in each of the four
         directions as a tuple (N, E, S, W).
+
+        The true distances come from the layout's precomputed wall ranges.
         """
         x, y = self.getPacmanPosition()
-        currentX = x
-        currentY = y
-        while not self.hasWall(currentX, currentY):
-            currentY += 1
-        N = getNoisyDistance((x,y), (currentX, currentY))
-        currentX = x
-        currentY = y
-        while not self.hasWall(currentX, currentY):
-            currentX += 1
-        E = getNoisyDistance((x,y), (currentX, currentY))
-        currentX = x
-        currentY = y
-        while not self.hasWall(currentX, currentY):
-            currentY -= 1
-        S = getNoisyDistance((x,y), (currentX, currentY))
-        currentX = x
-        currentY = y
-        while not self.hasWall(currentX, currentY):
-            currentX -= 1
-        W = getNoisyDistance((x,y), (currentX, currentY)) 
+        layout = self.data.layout
+        cell = x * layout.height + y
+        north, east, south, west = layout.getWallRanges()
+        N = addSonarNoise(north[cell])
+        E = addSonarNoise(east[cell])
+        S = addSonarNoise(south[cell])
+        W = addSonarNoise(west[cell])
         return (N, E, S, W)
 
     #############################################
@@ -314,6 +394,132 @@ class GameState:
             raise "Pacman's index passed to getGhostPosition"
         return self.data.agentStates[agentIndex]
 
+class SlamObservation:
+    """
+    The lean view of the game a SLAM agent is given each turn in place of a
+    full GameState copy: the noisy range measurements from Pacman's true
+    position and the actions that are legal there. It supports the
+    GameState methods SLAM agents use (getNoisyRangeMeasurements,
+    getLegalActions and getLegalPacmanActions).
+    """
+    def __init__(self, state, agentIndex=0):
+        self.agentIndex = agentIndex
+        self.ranges = state.getNoisyRangeMeasurements()
+        self.legalActions = state.getLegalActions(agentIndex)
+
+    def getNoisyRangeMeasurements(self):
+        return self.ranges
+
+    def getLegalActions(self, agentIndex=0):
+        if agentIndex != self.agentIndex:
+            raise Exception('Observation only knows the legal actions of agent %d' % self.agentIndex)
+        return self.legalActions[:]
+
+    def getLegalPacmanActions(self):
+        return self.getLegalActions(0)
+
+class BatchSlamSimulator:
+    """
+    Plays numEpisodes Pacman-only SLAM episodes on one layout in lockstep.
+
+    Each episode keeps just its pose (a cell index x * height + y in the
+    poses array), its score and its own random.Random, and every step
+    follows GameState.generateSuccessor, Actions.getNoisyAction and
+    GameState.getNoisyRangeMeasurements draw for draw. So an episode played
+    here with random.Random(seed) gives the same positions, sonar readings
+    and scores as a Game played after random.seed(seed) by an agent whose
+    choices do not use the random module.
+    """
+    def __init__(self, layout, numEpisodes, seeds=None, maxMoves=-1):
+        if seeds == None:
+            seeds = range(numEpisodes)
+        self.layout = layout
+        self.height = layout.height
+        self.numEpisodes = numEpisodes
+        self.maxMoves = maxMoves
+        self.numMoves = 0
+        self.rngs = [random.Random(seed) for seed in seeds[:numEpisodes]]
+        self.wallRanges = layout.getWallRanges()
+
+        # The legal actions (in getPossibleActions order) and successor cells
+        # of every open cell, so that a step is a few list lookups
+        walls = layout.walls
+        self.legalActions = {}
+        self.successors = {}
+        for x, y in walls.asList(False):
+            cell = x * self.height + y
+            legal = Actions.getPossibleActions(Configuration((x, y), Directions.STOP), walls)
+            self.legalActions[cell] = legal
+            self.successors[cell] = dict([(action, self.cellOf(Actions.getSuccessor((x, y), action))) for action in legal])
+
+        x, y = layout.agentPositions[0][1]
+        self.poses = array.array('i', [self.cellOf((x, y))] * numEpisodes)
+        self.scores = [0] * numEpisodes
+
+    def cellOf(self, pos):
+        x, y = pos
+        return int(x) * self.height + int(y)
+
+    def getPacmanPositions(self):
+        height = self.height
+        return [(cell / height, cell % height) for cell in self.poses]
+
+    def getLegalActions(self):
+        "Returns a copy of each episode's legal actions."
+        return [self.legalActions[cell][:] for cell in self.poses]
+
+    def getNoisyRangeMeasurements(self):
+        """
+        Returns an (N, E, S, W) tuple of noisy readings for each episode,
+        drawing the noise from that episode's random.Random.
+        """
+        north, east, south, west = self.wallRanges
+        return [tuple(addSonarNoiseToAll((north[cell], east[cell], south[cell], west[cell]), rng))
+                for cell, rng in zip(self.poses, self.rngs)]
+
+    def step(self, actions):
+        """
+        Applies each episode's intended action through the noisy action model
+        and returns the actions actually taken.
+        """
+        taken = []
+        poses, legalActions, successors = self.poses, self.legalActions, self.successors
+        for i in xrange(self.numEpisodes):
+            cell, rng = poses[i], self.rngs[i]
+            legal = legalActions[cell]
+            if rng.random() < Actions.CORRECT_ACTION_PROB:
+                action = actions[i]
+            else:
+                action = rng.choice(legal)
+            if action not in legal:
+                raise Exception("Illegal action " + str(action))
+            poses[i] = successors[cell][action]
+            self.scores[i] -= TIME_PENALTY
+            taken.append(action)
+        self.numMoves += 1
+        return taken
+
+    def isOver(self):
+        return self.maxMoves > 0 and self.numMoves >= self.maxMoves
+
+    def run(self, chooseActions):
+        """
+        Steps every episode until maxMoves, asking chooseActions(readings,
+        legalActions) for the list of intended actions each turn, and returns
+        each episode's history as a list of (position, readings, action
+        taken) tuples.
+        """
+        if self.maxMoves <= 0:
+            raise Exception('Batched episodes need a positive maxMoves')
+        histories = [[] for i in range(self.numEpisodes)]
+        while not self.isOver():
+            positions = self.getPacmanPositions()
+            readings = self.getNoisyRangeMeasurements()
+            taken = self.step(chooseActions(readings, self.getLegalActions()))
+            for history, pos, reading, action in zip(histories, positions, readings, taken):
+                history.append((pos, reading, action))
+        return histories
+
 ############################################################################
 #                     THE HIDDEN SECRETS OF PACMAN                         #
 #                                                                          #
@@ -327,20 +533,52 @@ class SlamRules:
     """
     These game rules manage the control flow of a game, deciding when
     and how the game starts and ends.
+
+    If log is set to a slamLog.SlamLogWriter, each of Pacman's moves is
+    added to it along with the sonar readings he observed before moving.
     """
 
+    def __init__( self ):
+        self.log = None
+        self.observed = None
+
     def newGame( self, layout, pacmanAgent, ghostAgents, display, maxMoves= 10 ):
         agents = [pacmanAgent] + ghostAgents
         initState = GameState()
         initState.initialize( layout, len(ghostAgents))
         startPos = initState.getPacmanPosition()
         wallPrior = calculateWallPrior(initState.getWalls())
-        pacmanAgent.tellGameInfo(startPos, initState.getWalls().width, initState.getWalls().height, wallPrior, initState.getLegalPositions())
+        if 'needsTrueWalls' in dir(pacmanAgent) and pacmanAgent.needsTrueWalls():
+            # Known-map inference (e.g. inference.HistogramFilter) is told the true walls
+            pacmanAgent.tellGameInfo(startPos, initState.getWalls().width, initState.getWalls().height, wallPrior, initState.getLegalPositions(), walls=initState.getWalls())
+        else:
+            pacmanAgent.tellGameInfo(startPos, initState.getWalls().width, initState.getWalls().height, wallPrior, initState.getLegalPositions())
         game = Game(agents, display, self)
         game.state = initState
         game.state.maxMoves = maxMoves
         return game
 
+    def getObservation(self, state, agentIndex):
+        """
+        Builds what an agent observes before acting (see Game.getObservedState):
+        only the sonar readings and legal actions, not a copy of the state.
+        """
+        observation = SlamObservation(state, agentIndex)
+        if agentIndex == 0:
+            self.observed = (state, observation.ranges)
+        return observation
+
+    def recordMove(self, state, agentIndex, intendedAction, action):
+        """
+        Called by the Game with each action before it is executed; adds
+        Pacman's moves to the log, if there is one.
+        """
+        if self.log == None or agentIndex != 0: return
+        ranges = None
+        if self.observed != None and self.observed[0] is state:
+            ranges = self.observed[1]
+        self.log.addStep(state.getPacmanPosition(), intendedAction, action, ranges)
+
     def process(self, state, game):
         """
         Checks to see whether it is time to end the game.
@@ -524,6 +762,13 @@ def readCommand( argv ):
                       help='Renders the ghosts in the display (cheating)', default=False)
     parser.add_option('-t', '--frameTime', dest='frameTime', type='float',
                       help=default('Time to delay between frames; <0 means keyboard'), default=0.1)
+    parser.add_option('-m', '--maxMoves', dest='maxMoves', type='int',
+                      help=default('Number of moves after which a game ends; <0 means never'), default=-1)
+    parser.add_option('-j', '--numWorkers', dest='numWorkers', type='int',
+                      help='Play seeded games in this many worker processes, without graphics (needs --maxMoves); '
+                           '1 plays them in this process, with the same results', default=None)
+    parser.add_option('-r', '--record', dest='record', metavar='FILE',
+                      help='Write a binary log of each game to FILE (numbered when playing several games)', default=None)
 
     options, otherjunk = parser.parse_args()
     if len(otherjunk) != 0:
@@ -554,6 +799,9 @@ def readCommand( argv ):
                                                                   options.showGhosts, \
                                                                   frameTime = options.frameTime)
     args['numGames'] = options.numGames
+    args['maxMoves'] = options.maxMoves
+    args['numWorkers'] = options.numWorkers
+    args['record'] = options.record
 
     return args
 
@@ -580,7 +828,13 @@ def loadAgent(pacman, nographics):
                 return getattr(module, pacman)
     raise Exception('The agent ' + pacman + ' is not specified in any *Agents.py.')
 
-def runGames( layout, pacman, ghosts, display, numGames, maxMoves=-1):
+def getRecordName(record, gameNumber, numGames):
+    "Numbers the log files when several games are recorded."
+    if numGames == 1: return record
+    root, ext = os.path.splitext(record)
+    return '%s-%d%s' % (root, gameNumber + 1, ext)
+
+def runGames( layout, pacman, ghosts, display, numGames, maxMoves=-1, record=None):
     # Hack for agents writing to the display
     import __main__
     __main__.__dict__['_display'] = display
@@ -589,21 +843,101 @@ def runGames( layout, pacman, ghosts, display, numGames, maxMoves=-1):
     games = []
 
     for i in range( numGames ):
+        if record:
+            import slamLog
+            rules.log = slamLog.SlamLogWriter(getRecordName(record, i, numGames), layout)
         game = rules.newGame( layout, pacman, ghosts, display, maxMoves )
         game.run()
+        if rules.log != None:
+            rules.log.close()
+            rules.log = None
         games.append(game)
 
     if numGames > 1:
-        scores = [game.state.getScore() for game in games]
-        wins = [game.state.isWin() for game in games]
-        winRate = wins.count(True)/ float(len(wins))
-        print 'Average Score:', sum(scores) / float(len(scores))
-        print 'Scores:       ', ', '.join([str(score) for score in scores])
-        print 'Win Rate:      %d/%d (%.2f)' % (wins.count(True), len(wins), winRate)
-        print 'Record:       ', ', '.join([ ['Loss', 'Win'][int(w)] for w in wins])
+        printSummary([game.state.getScore() for game in games], [game.state.isWin() for game in games])
 
     return games
 
+def printSummary(scores, wins, accuracies=None, times=None):
+    "Prints the scores and wins of several games, and their map accuracies and running times if given."
+    winRate = wins.count(True)/ float(len(wins))
+    print 'Average Score:', sum(scores) / float(len(scores))
+    print 'Scores:       ', ', '.join([str(score) for score in scores])
+    print 'Win Rate:      %d/%d (%.2f)' % (wins.count(True), len(wins), winRate)
+    print 'Record:       ', ', '.join([ ['Loss', 'Win'][int(w)] for w in wins])
+    if accuracies:
+        print 'Map Accuracy:  %.3f (min %.3f, max %.3f)' % (sum(accuracies) / len(accuracies), min(accuracies), max(accuracies))
+    if times:
+        print 'Time/Game:     %.2fs (total %.2fs)' % (sum(times) / len(times), sum(times))
+
+def getMapAccuracy(walls, wallBeliefs):
+    """
+    Returns the fraction of the cells of the walls Grid on which the wall
+    belief distribution, thresholded at 0.5, is right.
+    """
+    correct = 0
+    for x in range(walls.width):
+        for y in range(walls.height):
+            if (wallBeliefs[(x, y)] > 0.5) == bool(walls[x][y]):
+                correct += 1
+    return correct / float(walls.width * walls.height)
+
+def runSeededGame(task):
+    """
+    Plays one game without graphics after seeding the random module with
+    seed, and returns its score, whether it was won, its map accuracy and
+    running time. task is a
+    (layout, pacman, ghosts, maxMoves, seed) tuple so that this can be
+    handed to a multiprocessing pool; the agents are copied first, so the
+    same task always plays out the same way in any process.
+    """
+    import __main__, copy, textDisplay
+    layout, pacman, ghosts, maxMoves, seed = task
+    pacman = copy.deepcopy(pacman)
+    ghosts = copy.deepcopy(ghosts)
+    display = textDisplay.NullGraphics()
+    __main__.__dict__['_display'] = display
+    random.seed(seed)
+    startTime = time.time()
+    game = SlamRules().newGame( layout, pacman, ghosts, display, maxMoves )
+    game.run()
+    result = {'seed': seed, 'score': game.state.getScore(), 'win': game.state.isWin(),
+              'time': time.time() - startTime}
+    if 'inferenceModule' in dir(pacman):
+        result['mapAccuracy'] = getMapAccuracy(layout.walls, pacman.inferenceModule.getWallBeliefDistribution())
+    return result
+
+def runGamesParallel( layout, pacman, ghosts, numGames, maxMoves, seeds=None, numWorkers=None ):
+    """
+    Plays numGames games spread over a pool of numWorkers processes (one per
+    CPU by default) and returns the runSeededGame result of each, in order.
+
+    Game i is seeded with seeds[i]; by default the seeds are drawn from the
+    random module, so fixing its seed fixes every game. With numWorkers=1
+    the games are played in this process, with results identical to any
+    other number of workers.
+    """
+    if maxMoves <= 0:
+        raise Exception('Games run in parallel need a positive maxMoves')
+    if seeds == None:
+        seeds = [random.randint(0, sys.maxint) for i in range(numGames)]
+    tasks = [(layout, pacman, ghosts, maxMoves, seed) for seed in seeds[:numGames]]
+    if numWorkers == 1:
+        results = map(runSeededGame, tasks)
+    else:
+        import multiprocessing
+        pool = multiprocessing.Pool(numWorkers)
+        try:
+            results = pool.map(runSeededGame, tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+    printSummary([result['score'] for result in results], [result['win'] for result in results],
+                 [result['mapAccuracy'] for result in results if 'mapAccuracy' in result],
+                 [result['time'] for result in results])
+    return results
+
 if __name__ == '__main__':
     """
     The main function called when pacman.py is run
@@ -616,4 +950,9 @@ if __name__ == '__main__':
     > python pacman.py --help
     """
     args = readCommand( sys.argv[1:] ) # Get game components based on input
-    runGames( **args )
+    numWorkers = args.pop('numWorkers')
+    if numWorkers != None:
+        if args['record']: raise Exception('Games run in parallel cannot be recorded')
+        runGamesParallel( args['layout'], args['pacman'], args['ghosts'], args['numGames'], args['maxMoves'], numWorkers=numWorkers )
+    else:
+        runGames( **args )
@@ -44,16 +44,22 @@ class KeyboardInference(inference.InferenceModule):
         self.beliefs = util.Counter()
         for p in self.legalPositions: self.beliefs[p] = 1.0
         self.beliefs.normalize()
+        # One table for the whole game: it holds every distance between two legal positions, and every
+        # noisy distance those can give
+        xs = [p[0] for p in self.legalPositions]
+        ys = [p[1] for p in self.legalPositions]
+        self.emissionModel = slam.getObservationTable(max(xs) - min(xs) + max(ys) - min(ys) + slam.SONAR_MAX)
 
     def observe(self, observation, gameState):
         noisyDistance = observation
-        emissionModel = slam.getObservationDistribution(noisyDistance)
-        pacmanPosition = gameState.getPacmanPosition()
         allPossible = util.Counter()
-        for p in self.legalPositions:
-            trueDistance = util.manhattanDistance(p, pacmanPosition)
-            if emissionModel[trueDistance] > 0:
-                allPossible[p] = 1.0
+        if noisyDistance != None and noisyDistance <= self.emissionModel.maxNoisy:
+            pacmanPosition = gameState.getPacmanPosition()
+            trueDistances = [util.manhattanDistance(p, pacmanPosition) for p in self.legalPositions]
+            likelihoods = self.emissionModel.gatherLikelihoods(noisyDistance, trueDistances)
+            for p, likelihood in zip(self.legalPositions, likelihoods):
+                if likelihood > 0:
+                    allPossible[p] = 1.0
         allPossible.normalize()
         self.beliefs = allPossible
 
@@ -67,14 +73,27 @@ class KeyboardInference(inference.InferenceModule):
 class SLAMAgent:
     "An agent that tracks and displays its beliefs about wall positions and its own position."
 
+    # Set to True to get a full GameState copy in observationFunction instead of a slam.SlamObservation
+    observeFullState = False
+
     def __init__( self, index = 0, inference = "SLAMParticleFilter", ghostAgents = None, observeEnable = True, elapseTimeEnable = True):
         self.inferenceType = util.lookup(inference, globals())     
         self.observeEnable = observeEnable
         self.elapseTimeEnable = elapseTimeEnable
         self.prevAction = None
         
-    def tellGameInfo(self, startPos, width, height, wallPrior, legalPositions):
-        self.inferenceModules = [self.inferenceType(startPos, width, height, wallPrior, legalPositions)]
+    def needsTrueWalls(self):
+        """
+        Whether tellGameInfo must be given the true walls: true for inference
+        classes that localize on a known map (usesKnownMap) instead of mapping.
+        """
+        return getattr(self.inferenceType, 'usesKnownMap', False)
+
+    def tellGameInfo(self, startPos, width, height, wallPrior, legalPositions, walls=None):
+        if self.needsTrueWalls():
+            self.inferenceModules = [self.inferenceType(startPos, width, height, wallPrior, legalPositions, walls=walls)]
+        else:
+            self.inferenceModules = [self.inferenceType(startPos, width, height, wallPrior, legalPositions)]
         self.inferenceModule = self.inferenceModules[0]
 
     def registerInitialState(self, gameState):
@@ -90,7 +109,8 @@ class SLAMAgent:
         regardless of if that action was actually successful.
         
         Returns the gameState for bookkeeping purposes, though this is
-        not known to the inference module.
+        not known to the inference module. Unless observeFullState is set
+        this is a slam.SlamObservation rather than a full GameState.
         """        
         return gameState.getNoisyRangeMeasurements(), self.prevAction, gameState
 
@@ -127,15 +147,15 @@ class SLAMKeyboardAgent(SLAMAgent, KeyboardAgent):
         self.prevAction = action
         return action
 
-from distanceCalculator import Distancer
+from distanceCalculator import LazyDistancer
 
 class AutoSLAMAgent(SLAMAgent):
     "An agent that moves automatically at random."
 
     def registerInitialState(self, gameState):
-        "Pre-computes the distance between every two points."
+        "Sets up maze distances, which are only computed when first needed."
         SLAMAgent.registerInitialState(self, gameState)
-        self.distancer = Distancer(gameState.data.layout, False)
+        self.distancer = LazyDistancer(gameState.data.layout)
 
     def chooseAction(self, gameState):
         legal = [a for a in gameState.getLegalPacmanActions()]
@@ -148,9 +168,9 @@ class PatrolSLAMAgent(SLAMAgent):
     "An agent that tends to move forward and avoids backtracking when possible."
     
     def registerInitialState(self, gameState):
-        "Pre-computes the distance between every two points."
+        "Sets up maze distances, which are only computed when first needed."
         SLAMAgent.registerInitialState(self, gameState)
-        self.distancer = Distancer(gameState.data.layout, False)
+        self.distancer = LazyDistancer(gameState.data.layout)
 
     def chooseAction(self, gameState):
         legal = [a for a in gameState.getLegalPacmanActions()]
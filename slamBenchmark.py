@@ -0,0 +1,204 @@
+# slamBenchmark.py
+# ----------------
+# Licensing Information:  You are free to use or extend these projects for
+# educational purposes provided that (1) you do not distribute or publish
+# solutions, (2) you retain this notice, and (3) you provide clear
+# attribution to UC Berkeley, including a link to
+# http://inst.eecs.berkeley.edu/~cs188/pacman/pacman.html
+#
+# Attribution Information: The Pacman AI projects were developed at UC Berkeley.
+# The core projects and autograders were primarily created by John DeNero
+# (denero@cs.berkeley.edu) and Dan Klein (klein@cs.berkeley.edu).
+# Student side autograding was added by Brad Miller, Nick Hay, and
+# Pieter Abbeel (pabbeel@cs.berkeley.edu).
+
+
+"""
+slamBenchmark.py times inference modules on recorded SLAM games.
+
+The (prevAction, ranges) stream a SLAMAgent would hand to observe is
+rebuilt from logs written with 'python slam.py --record FILE' and fed
+straight into each inference class, with no Game, agent or display (and
+so no Tk). For every log, inference class and particle count it reports
+the latency percentiles of one step, the throughput and the peak memory.
+Each configuration runs in its own process so memory peaks don't mix.
+
+  python slamBenchmark.py -i SLAMParticleFilter -n 50,100,200 game.slog
+"""
+
+import inference
+import layout
+import slam
+import slamLog
+import inspect, math, optparse, random, resource, sys, time
+
+def getObservations(log):
+    """
+    Returns the (prevAction, ranges) pairs a SLAMAgent passes to observe over
+    the logged game: the readings at each step with the action attempted at
+    the step before. Steps without readings are skipped.
+    """
+    observations = []
+    prevAction = None
+    for pos, attempted, executed, ranges in log:
+        if ranges != None:
+            observations.append((prevAction, ranges))
+        prevAction = attempted
+    return observations
+
+def loadLogLayout(log):
+    "Finds the layout a log was recorded on, checking that it is unchanged."
+    board = layout.getLayout(log.layoutName)
+    if board == None:
+        raise Exception('The layout ' + log.layoutName + ' cannot be found')
+    if not log.matchesLayout(board):
+        raise Exception('The layout ' + log.layoutName + ' has changed since ' + log.filename + ' was recorded')
+    return board
+
+def getPercentile(sortedValues, percent):
+    """
+    Nearest-rank percentile of an already sorted list: the smallest value
+    that at least percent of the values are less than or equal to.
+    """
+    rank = int(math.ceil(percent / 100.0 * len(sortedValues)))
+    return sortedValues[max(rank, 1) - 1]
+
+def getPeakMemory():
+    "Peak resident set size of this process in megabytes."
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak / (1024.0 * 1024.0)
+    return peak / 1024.0
+
+def hasParticles(inferenceType):
+    "Whether an inference class takes a numParticles argument."
+    return 'numParticles' in inspect.getargspec(inferenceType.__init__).args
+
+def benchmark(filename, inferenceName, numParticles, queryBeliefs=False, seed=0):
+    """
+    Replays one log into a new inferenceName module with numParticles
+    particles (if it has particles) and returns a dictionary of timings.
+    Modules that localize on a known map are given the layout's walls. With
+    queryBeliefs, both belief distributions are also computed after every
+    step, as SLAMAgent does.
+    """
+    log = slamLog.SlamLogReader(filename)
+    try:
+        board = loadLogLayout(log)
+        observations = getObservations(log)
+        startPos = log[0][0]
+    finally:
+        log.close()
+
+    random.seed(seed)
+    walls = board.walls
+    legalPositions = walls.asList() + walls.asList(False)
+    inferenceType = getattr(inference, inferenceName)
+    options = {}
+    if hasParticles(inferenceType):
+        options['numParticles'] = numParticles
+    else:
+        numParticles = None
+    if getattr(inferenceType, 'usesKnownMap', False):
+        options['walls'] = walls
+    startTime = time.time()
+    module = inferenceType(startPos, walls.width, walls.height, slam.calculateWallPrior(walls),
+                           legalPositions, **options)
+    setupTime = time.time() - startTime
+
+    latencies = []
+    clock = time.time
+    for prevAction, ranges in observations:
+        stepStart = clock()
+        module.observe(prevAction, ranges)
+        if queryBeliefs:
+            module.getWallBeliefDistribution()
+            module.getPositionBeliefDistribution()
+        latencies.append(clock() - stepStart)
+
+    total = sum(latencies)
+    latencies.sort()
+    return {'layout': board.name, 'inference': inferenceName, 'numParticles': numParticles,
+            'steps': len(latencies), 'setup': setupTime, 'total': total,
+            'stepsPerSecond': len(latencies) / total if total > 0 else float('inf'),
+            'p50': getPercentile(latencies, 50), 'p90': getPercentile(latencies, 90),
+            'p99': getPercentile(latencies, 99), 'max': latencies[-1],
+            'peakMemory': getPeakMemory(), 'queryBeliefs': queryBeliefs}
+
+def runBenchmark(task):
+    "Unpacks a task tuple for a process pool."
+    return benchmark(*task)
+
+def runBenchmarks(filenames, inferenceNames, particleCounts, queryBeliefs=False, seed=0, separateProcesses=True):
+    """
+    Benchmarks every combination of log, inference class and particle count,
+    each in a fresh process unless separateProcesses is False. Classes
+    without particles run once per log.
+    """
+    tasks = []
+    for filename in filenames:
+        for inferenceName in inferenceNames:
+            if hasParticles(getattr(inference, inferenceName)):
+                counts = particleCounts
+            else:
+                counts = [None]
+            for numParticles in counts:
+                tasks.append((filename, inferenceName, numParticles, queryBeliefs, seed))
+    if not separateProcesses:
+        return map(runBenchmark, tasks)
+    import multiprocessing
+    results = []
+    for task in tasks:
+        pool = multiprocessing.Pool(1)
+        try:
+            results.append(pool.apply(runBenchmark, (task,)))
+        finally:
+            pool.close()
+            pool.join()
+    return results
+
+def printResults(results):
+    row = '%-16s %-22s %9s %6s %10s %9s %9s %9s %9s %9s'
+    print row % ('Layout', 'Inference', 'Particles', 'Steps', 'Steps/s',
+                 'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'peak MB')
+    for result in results:
+        print row % (result['layout'], result['inference'], result['numParticles'], result['steps'],
+                     '%.1f' % result['stepsPerSecond'],
+                     '%.3f' % (1000 * result['p50']), '%.3f' % (1000 * result['p90']),
+                     '%.3f' % (1000 * result['p99']), '%.3f' % (1000 * result['max']),
+                     '%.1f' % result['peakMemory'])
+    if results:
+        if results[0]['queryBeliefs']:
+            print 'peak MB includes computing both belief distributions after every step (-b)'
+        else:
+            print 'peak MB is for observe alone; -b also computes the belief distributions after every step'
+
+def readCommand(argv):
+    usageStr = """
+    USAGE:      python slamBenchmark.py <options> LOG [LOG ...]
+    EXAMPLE:    python slamBenchmark.py -n 50,100,200 game.slog
+                  - times SLAMParticleFilter with three particle counts
+    """
+    parser = optparse.OptionParser(usageStr)
+    parser.add_option('-i', '--inference', dest='inference', default='SLAMParticleFilter',
+                      help='Comma separated inference classes to time (default SLAMParticleFilter)')
+    parser.add_option('-n', '--numParticles', dest='numParticles', default='100',
+                      help='Comma separated particle counts to time (default 100)')
+    parser.add_option('-b', '--beliefs', action='store_true', dest='queryBeliefs', default=False,
+                      help='Also compute both belief distributions after each step')
+    parser.add_option('-s', '--seed', type='int', dest='seed', default=0,
+                      help='Random seed for each run (default 0)')
+    parser.add_option('--inProcess', action='store_false', dest='separateProcesses', default=True,
+                      help='Run every configuration in this process')
+    options, filenames = parser.parse_args(argv)
+    if len(filenames) == 0:
+        parser.error('No logs given')
+    return {'filenames': filenames,
+            'inferenceNames': options.inference.split(','),
+            'particleCounts': [int(n) for n in options.numParticles.split(',')],
+            'queryBeliefs': options.queryBeliefs,
+            'seed': options.seed,
+            'separateProcesses': options.separateProcesses}
+
+if __name__ == '__main__':
+    printResults(runBenchmarks(**readCommand(sys.argv[1:])))
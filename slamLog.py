@@ -0,0 +1,169 @@
+# slamLog.py
+# ----------
+# Licensing Information:  You are free to use or extend these projects for
+# educational purposes provided that (1) you do not distribute or publish
+# solutions, (2) you retain this notice, and (3) you provide clear
+# attribution to UC Berkeley, including a link to
+# http://inst.eecs.berkeley.edu/~cs188/pacman/pacman.html
+#
+# Attribution Information: The Pacman AI projects were developed at UC Berkeley.
+# The core projects and autograders were primarily created by John DeNero
+# (denero@cs.berkeley.edu) and Dan Klein (klein@cs.berkeley.edu).
+# Student side autograding was added by Brad Miller, Nick Hay, and
+# Pieter Abbeel (pabbeel@cs.berkeley.edu).
+
+
+"""
+slamLog.py reads and writes compact binary logs of SLAM games.
+
+A log holds one step per Pacman move: his true position, the action he
+attempted, the action the noisy action model actually executed and the
+four sonar readings (N, E, S, W) he received before moving. The file is
+a little-endian header followed by one column per field:
+
+  magic 'SLAMLOG\\0', version, layout width and height, item size (1 or 2
+  bytes), number of steps, SHA-1 of the layout text, layout name length,
+  layout name, then the columns x, y, attempted, executed, N, E, S, W,
+  each holding one unsigned item per step.
+
+Actions are stored as their index in ACTIONS, and a step whose sonar
+readings were never observed stores NO_READING in all four range columns.
+SlamLogReader memory-maps a log and decodes steps only as they are asked
+for, so long logs can be streamed without loading them.
+"""
+
+from game import Directions
+import array, hashlib, mmap, os, struct, sys
+
+MAGIC = 'SLAMLOG\0'
+VERSION = 1
+HEADER = struct.Struct('<8sHHHBxI20sH')
+ACTIONS = [Directions.NORTH, Directions.EAST, Directions.SOUTH, Directions.WEST, Directions.STOP]
+ACTION_CODES = dict([(action, code) for code, action in enumerate(ACTIONS)])
+COLUMNS = ['x', 'y', 'attempted', 'executed', 'north', 'east', 'south', 'west']
+
+def getLayoutHash(layout):
+    "Returns the SHA-1 digest identifying the layout's text."
+    return hashlib.sha1('\n'.join(layout.layoutText)).digest()
+
+def getItemSize(width, height):
+    "Coordinates and ranges need one byte unless the layout is 255 cells across."
+    if max(width, height) < 255:
+        return 1
+    return 2
+
+class SlamLogWriter:
+    """
+    Collects the steps of one game and writes them to filename on close().
+    """
+    def __init__(self, filename, layout):
+        self.filename = filename
+        self.width = layout.width
+        self.height = layout.height
+        self.layoutName = layout.name or ''
+        self.layoutHash = getLayoutHash(layout)
+        self.itemSize = getItemSize(self.width, self.height)
+        self.noReading = 256 ** self.itemSize - 1
+        self.columns = [array.array('BH'[self.itemSize - 1]) for column in COLUMNS]
+
+    def addStep(self, pos, attemptedAction, executedAction, ranges):
+        """
+        Appends one step. ranges is the (N, E, S, W) reading Pacman received
+        at pos, or None if he did not observe one.
+        """
+        if ranges == None:
+            ranges = (self.noReading,) * 4
+        x, y = pos
+        values = (int(x), int(y), ACTION_CODES[attemptedAction], ACTION_CODES[executedAction]) + tuple(ranges)
+        for column, value in zip(self.columns, values):
+            column.append(value)
+
+    def __len__(self):
+        return len(self.columns[0])
+
+    def close(self):
+        name = self.layoutName
+        f = open(self.filename, 'wb')
+        try:
+            f.write(HEADER.pack(MAGIC, VERSION, self.width, self.height, self.itemSize,
+                                len(self), self.layoutHash, len(name)))
+            f.write(name)
+            for column in self.columns:
+                if sys.byteorder == 'big':
+                    column = array.array(column.typecode, column)
+                    column.byteswap()
+                column.tofile(f)
+        finally:
+            f.close()
+
+class SlamLogReader:
+    """
+    A read-only, memory-mapped view of a log written by SlamLogWriter.
+
+    Steps are (pos, attemptedAction, executedAction, ranges) tuples, with
+    ranges None where no reading was observed. They can be read by index or
+    iterated over lazily.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        f = open(filename, 'rb')
+        try:
+            size = os.fstat(f.fileno()).st_size
+            if size < HEADER.size:
+                raise Exception('%s is too short to be a SLAM log' % filename)
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+
+        (magic, version, self.width, self.height, self.itemSize, self.numSteps,
+         self.layoutHash, nameLength) = HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC:
+            raise Exception('%s is not a SLAM log' % filename)
+        if version != VERSION:
+            raise Exception('%s has unsupported SLAM log version %d' % (filename, version))
+        start = HEADER.size
+        self.layoutName = self.data[start:start + nameLength]
+        start += nameLength
+
+        self.item = struct.Struct('<' + 'BH'[self.itemSize - 1])
+        self.noReading = 256 ** self.itemSize - 1
+        self.columnOffsets = [start + i * self.numSteps * self.itemSize for i in range(len(COLUMNS))]
+        if size < self.columnOffsets[-1] + self.numSteps * self.itemSize:
+            raise Exception('%s is truncated' % filename)
+
+    def matchesLayout(self, layout):
+        "Tells whether this log was recorded on the given layout."
+        return getLayoutHash(layout) == self.layoutHash
+
+    def __len__(self):
+        return self.numSteps
+
+    def getColumn(self, name):
+        "Returns every value of one column, undecoded, as an array."
+        start = self.columnOffsets[COLUMNS.index(name)]
+        column = array.array(self.item.format[1])
+        column.fromstring(self.data[start:start + self.numSteps * self.itemSize])
+        if sys.byteorder == 'big':
+            column.byteswap()
+        return column
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.numSteps
+        if not 0 <= index < self.numSteps:
+            raise IndexError('SLAM log step out of range')
+        offset = index * self.itemSize
+        unpack, data = self.item.unpack_from, self.data
+        x, y, attempted, executed, north, east, south, west = \
+            [unpack(data, start + offset)[0] for start in self.columnOffsets]
+        ranges = (north, east, south, west)
+        if north == self.noReading:
+            ranges = None
+        return ((x, y), ACTIONS[attempted], ACTIONS[executed], ranges)
+
+    def __iter__(self):
+        for index in xrange(self.numSteps):
+            yield self[index]
+
+    def close(self):
+        self.data.close()
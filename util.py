@@ -17,6 +17,7 @@ import sys
 import inspect
 import heapq, random
 import cStringIO
+import bisect
 
 
 class FixedRandom:
@@ -483,6 +484,37 @@ def sample(distribution, values = None):
         total += distribution[i]
     return values[i]
 
+class DiscreteSampler:
+    """
+    A reusable sampler for a fixed discrete distribution over values.
+
+    The distribution is normalized and its cumulative sums are computed once,
+    so each draw is a single random number and a bisect instead of the
+    normalize-and-scan done by sample(). A draw returns exactly what
+    sample(distribution, values) would have returned for the same random
+    number, so seeded runs are unchanged.
+    """
+    def __init__(self, distribution, values):
+        if sum(distribution) != 1:
+            distribution = normalize(distribution)
+        self.values = list(values)
+        self.cdf = []
+        total = 0.0
+        for i, prob in enumerate(distribution):
+            total = prob if i == 0 else total + prob
+            self.cdf.append(total)
+        self.last = len(self.values) - 1
+
+    def sample(self, rng=random):
+        "Draws one value, using rng (the random module by default)."
+        return self.values[min(self.last, bisect.bisect_left(self.cdf, rng.random()))]
+
+    def nSample(self, n, rng=random):
+        "Draws n independent values in one call."
+        values, cdf, last = self.values, self.cdf, self.last
+        r, find = rng.random, bisect.bisect_left
+        return [values[min(last, find(cdf, r()))] for i in xrange(n)]
+
 def sampleFromCounter(ctr):
     items = sorted(ctr.items())
     return sample([v for k,v in items], [k for k,v in items])